@@ -0,0 +1,323 @@
+# Benchmarks against a local stand-in for the Anthropic Messages API.
+#
+#   python bench.py --scenarios build,inquiry,webhooks,assets --latency 0.3
+#
+# Results are appended as one JSON line per run (with the git commit) to
+# bench_results.jsonl so runs can be compared across commits.
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import gevent
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+import requests
+
+ARRAY_SIZES = {"posts": 14, "emails": 5, "leads": 10}
+
+# Mock Messages API
+class MockAnthropic:
+    def __init__(self, latency=0.3, tokens_per_sec=400, error_rate=0.0, overload_rate=0.0):
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.error_rate = error_rate
+        self.overload_rate = overload_rate
+        self.ids = itertools.count(1)
+        self.calls = 0
+        self.errors = 0
+
+    def sample(self, schema, key="value"):
+        kind = schema.get("type")
+        if kind == "object":
+            return {k: self.sample(sub, k) for k, sub in schema.get("properties", {}).items()}
+        if kind == "array":
+            items = schema.get("items", {"type": "string"})
+            return [self.sample(items, key) for _ in range(ARRAY_SIZES.get(key, 3))]
+        if kind == "number":
+            return random.choice([17, 27, 37, 47])
+        if kind == "boolean":
+            return random.random() < 0.3
+        return f"{key} {random.randint(1000, 9999)}"
+
+    def answer(self, body):
+        tools = body.get("tools")
+        if tools:
+            return None, self.sample(tools[0]["input_schema"])
+        prompt = body["messages"][-1]["content"]
+        match = re.search(r"Return JSON:\s*(\{[\s\S]*\})", prompt)
+        example = {}
+        if match:
+            try:
+                example = json.loads(match.group(1).split("\n\nRespond with valid JSON only.")[0])
+            except ValueError:
+                pass
+        return json.dumps(self.sample(schema_of(example)) if example else {"response": "ok"}), None
+
+    def error(self, start_response):
+        if random.random() < self.error_rate:
+            status, kind, message = "429 Too Many Requests", "rate_limit_error", "Rate limited"
+        elif random.random() < self.overload_rate:
+            status, kind, message = "529 Overloaded", "overloaded_error", "Overloaded"
+        else:
+            return None
+        self.errors += 1
+        start_response(status, [("Content-Type", "application/json"), ("retry-after", "0.2")])
+        return [json.dumps({"type": "error", "error": {"type": kind, "message": message}}).encode()]
+
+    def __call__(self, environ, start_response):
+        if environ["PATH_INFO"] != "/v1/messages" or environ["REQUEST_METHOD"] != "POST":
+            start_response("404 Not Found", [("Content-Type", "application/json")])
+            return [b'{"type":"error","error":{"type":"not_found_error","message":"Not found"}}']
+        body = json.loads(environ["wsgi.input"].read() or b"{}")
+        self.calls += 1
+        gevent.sleep(self.latency)
+        failure = self.error(start_response)
+        if failure:
+            return failure
+
+        text, tool_input = self.answer(body)
+        output = json.dumps(tool_input) if tool_input is not None else text
+        input_tokens = len(json.dumps(body.get("system", "")) + json.dumps(body["messages"])) // 4
+        output_tokens = max(1, len(output) // 4)
+        truncated = output_tokens > body.get("max_tokens", output_tokens)
+        if truncated:
+            output_tokens = body["max_tokens"]
+            output = output[:output_tokens * 4]
+            text = text and output
+        message_id = f"msg_bench_{next(self.ids)}"
+        headers = [
+            ("anthropic-ratelimit-requests-limit", "100000"),
+            ("anthropic-ratelimit-requests-remaining", "99999"),
+            ("anthropic-ratelimit-tokens-limit", "100000000"),
+            ("anthropic-ratelimit-tokens-remaining", "99999999")
+        ]
+
+        if body.get("stream"):
+            start_response("200 OK", [("Content-Type", "text/event-stream")] + headers)
+            return self.stream(body, message_id, text or output, input_tokens, output_tokens, "max_tokens" if truncated else "end_turn")
+
+        if tool_input is not None:
+            content = [{"type": "tool_use", "id": f"toolu_{message_id}", "name": body["tools"][0]["name"], "input": tool_input}]
+            stop_reason = "tool_use"
+        else:
+            content = [{"type": "text", "text": text}]
+            stop_reason = "end_turn"
+        if truncated:
+            stop_reason = "max_tokens"
+        gevent.sleep(output_tokens / self.tokens_per_sec)
+        start_response("200 OK", [("Content-Type", "application/json")] + headers)
+        return [json.dumps({
+            "id": message_id,
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model"),
+            "content": content,
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens}
+        }).encode()]
+
+    def stream(self, body, message_id, text, input_tokens, output_tokens, stop_reason):
+        def event(kind, payload):
+            return f"event: {kind}\ndata: {json.dumps({'type': kind, **payload})}\n\n".encode()
+
+        yield event("message_start", {"message": {
+            "id": message_id, "type": "message", "role": "assistant", "model": body.get("model"),
+            "content": [], "stop_reason": None, "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": 1}
+        }})
+        yield event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+        step = 16
+        for i in range(0, len(text), step):
+            gevent.sleep(step / 4 / self.tokens_per_sec)
+            yield event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": text[i:i + step]}})
+        yield event("content_block_stop", {"index": 0})
+        yield event("message_delta", {"delta": {"stop_reason": stop_reason, "stop_sequence": None}, "usage": {"output_tokens": output_tokens}})
+        yield event("message_stop", {})
+
+def schema_of(example, key="value"):
+    if isinstance(example, dict):
+        return {"type": "object", "properties": {k: schema_of(v, k) for k, v in example.items()}}
+    if isinstance(example, list):
+        return {"type": "array", "items": schema_of(example[0], key) if example else {"type": "string"}}
+    if isinstance(example, bool):
+        return {"type": "boolean"}
+    if isinstance(example, (int, float)):
+        return {"type": "number"}
+    return {"type": "string"}
+
+# Measurement
+def summarize(latencies, wall):
+    ordered = sorted(latencies)
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 2) if ordered else None
+    return {
+        "requests": len(ordered),
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(ordered) / wall, 2) if wall else None,
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "p99_ms": pct(99),
+        "max_ms": round(ordered[-1] * 1000, 2) if ordered else None
+    }
+
+def fan_out(fn, count, concurrency):
+    latencies, failures = [], [0]
+    def timed(i):
+        start = time.monotonic()
+        try:
+            fn(i)
+            latencies.append(time.monotonic() - start)
+        except Exception:
+            failures[0] += 1
+    start = time.monotonic()
+    Pool(concurrency).map(timed, range(count))
+    return {**summarize(latencies, time.monotonic() - start), "failures": failures[0]}
+
+# Scenarios
+def bench_build(base, args):
+    runs = []
+    for _ in range(args.builds):
+        start = time.monotonic()
+        job = requests.post(f"{base}/build", json={"niche": f"bench {random.random()}", "cache": False}).json()
+        status = None
+        with requests.get(f"{base}/jobs/{job['job_id']}/events", stream=True) as events:
+            for line in events.iter_lines(decode_unicode=True):
+                if line.startswith("event: ") and line[7:] in ("complete", "failed", "cancelled"):
+                    status = line[7:]
+                    break
+        record = requests.get(f"{base}/jobs/{job['job_id']}").json()
+        runs.append({"status": status, "wall_seconds": round(time.monotonic() - start, 3), "stage_timings": record.get("timings")})
+    walls = sorted(r["wall_seconds"] for r in runs)
+    return {"builds": runs, "median_wall_seconds": walls[len(walls) // 2]}
+
+def bench_inquiry(base, args):
+    def ask(i):
+        requests.post(f"{base}/inquiry", json={"message": f"Does this work for case {i}?"}).raise_for_status()
+    def ask_stream(i):
+        with requests.post(f"{base}/inquiry/stream", json={"message": f"Streaming question {i}"}, stream=True) as response:
+            for _ in response.iter_content(chunk_size=None):
+                break
+    return {
+        "blocking": fan_out(ask, args.requests, args.concurrency),
+        "stream_first_byte": fan_out(ask_stream, args.requests, args.concurrency)
+    }
+
+def bench_webhooks(base, args):
+    sale_ids = [i % max(1, int(args.requests * 0.8)) for i in range(args.requests * 5)]
+    def post(i):
+        requests.post(f"{base}/webhook/payhip", json={"id": f"bench-{sale_ids[i]}", "email": f"buyer{i}@example.com", "price": "10"}).raise_for_status()
+    before = requests.get(f"{base}/customers?limit=1").json()
+    result = fan_out(post, len(sale_ids), args.concurrency * 5)
+    gevent.sleep(0.5)
+    after = requests.get(f"{base}/customers?limit=1").json()
+    result["unique_sales"] = len(set(sale_ids))
+    result["customers_added"] = after["count"] - before["count"]
+    result["counted_exactly_once"] = result["customers_added"] == result["unique_sales"]
+    return result
+
+def bench_assets(base, args, main):
+    sizes = []
+    ws = main.workspaces.acquire(main.DEFAULT_WORKSPACE)
+    for target in args.asset_sizes:
+        missing = target - len(ws.data["customers"])
+        if missing > 0:
+            ws.store.record("customers", customers=[
+                {"email": f"seed{i}@example.com", "price": 27, "source": "bench", "time": datetime.now().isoformat(), "event_id": f"bench-seed:{target}:{i}"}
+                for i in range(missing)
+            ])
+        row = {"customers": len(ws.data["customers"])}
+        for encoding in ("identity", "gzip"):
+            start = time.monotonic()
+            response = requests.get(f"{base}/assets", headers={"Accept-Encoding": encoding}, stream=True)
+            size = sum(len(chunk) for chunk in response.raw.stream(64 * 1024, decode_content=False))
+            row[encoding] = {"bytes": size, "ms": round((time.monotonic() - start) * 1000, 2)}
+        start = time.monotonic()
+        page = requests.get(f"{base}/customers?limit=100")
+        row["customers_page"] = {"bytes": len(page.content), "ms": round((time.monotonic() - start) * 1000, 2)}
+        sizes.append(row)
+    main.workspaces.release(ws)
+    return {"sizes": sizes}
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the app against a mock Anthropic API")
+    parser.add_argument("--scenarios", default="build,inquiry,webhooks,assets")
+    parser.add_argument("--latency", type=float, default=0.3, help="mock API latency before the first token (seconds)")
+    parser.add_argument("--tokens-per-sec", type=float, default=400, help="mock output token rate")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--overload-rate", type=float, default=0.0, help="fraction of calls answered with 529")
+    parser.add_argument("--builds", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--asset-sizes", type=lambda s: [int(n) for n in s.split(",")], default=[1000, 10000, 50000])
+    parser.add_argument("--output", default="bench_results.jsonl")
+    args = parser.parse_args()
+
+    mock = MockAnthropic(args.latency, args.tokens_per_sec, args.error_rate, args.overload_rate)
+    mock_server = WSGIServer(("127.0.0.1", 0), mock, log=None)
+    mock_server.start()
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.environ.update({
+        "ANTHROPIC_BASE_URL": f"http://127.0.0.1:{mock_server.server_port}",
+        "ANTHROPIC_API_KEY": "bench",
+        "STATE_FILE": os.path.join(workdir, "business.json"),
+        "EVENT_LOG": os.path.join(workdir, "events.log"),
+        "WORKSPACE_DIR": os.path.join(workdir, "workspaces"),
+        "JOB_DIR": os.path.join(workdir, "jobs")
+    })
+    os.environ.setdefault("SCHEDULER", "0")
+    os.environ.setdefault("API_RPM", "100000")
+    os.environ.setdefault("API_TPM", "100000000")
+    os.environ.pop("CACHE_DB", None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    app_server = WSGIServer(("127.0.0.1", 0), main.app, log=None)
+    app_server.start()
+    base = f"http://127.0.0.1:{app_server.server_port}"
+
+    scenarios = {
+        "build": lambda: bench_build(base, args),
+        "inquiry": lambda: bench_inquiry(base, args),
+        "webhooks": lambda: bench_webhooks(base, args),
+        "assets": lambda: bench_assets(base, args, main)
+    }
+    results = {}
+    for name in args.scenarios.split(","):
+        print(f"Running {name}...")
+        results[name] = scenarios[name]()
+        print(json.dumps(results[name], indent=2))
+
+    record = {
+        "commit": git_commit(),
+        "time": datetime.now().isoformat(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "mock": {"calls": mock.calls, "errors": mock.errors},
+        "results": results
+    }
+    with open(args.output, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    print(f"Results appended to {args.output}")
+
+    app_server.stop()
+    mock_server.stop()
+
+if __name__ == "__main__":
+    main_cli()
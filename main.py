@@ -1,85 +1,2196 @@
+from gevent import monkey
+monkey.patch_all()
+
 import anthropic
+import atexit
+import base64
+import bisect
+import fcntl
+import gevent
+import hashlib
+import heapq
+import itertools
 import json
+import mmap
 import os
+import queue
+import random
 import re
-from datetime import datetime
-from flask import Flask, request, jsonify
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
+from flask import Flask, Response, g, has_request_context, request, jsonify, stream_with_context
+from gevent.pool import Pool
+import numpy as np
 import requests
 
-client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"), max_retries=0)
 app = Flask(__name__)
 
+# Response Cache
+class ResponseCache:
+    def __init__(self, max_entries=None, path=None):
+        self.max_entries = max_entries or int(os.environ.get("CACHE_SIZE", 512))
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            self.db.commit()
+    
+    @staticmethod
+    def key(request):
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+    
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self.entries[key]
+            if self.db:
+                row = self.db.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+                if row and row[1] > now:
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+    
+    def set(self, key, value, ttl):
+        expires = time.time() + ttl
+        with self.lock:
+            self._remember(key, value, expires)
+            if self.db:
+                self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, value, expires))
+                self.db.commit()
+    
+    def _remember(self, key, value, expires):
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+    
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            if self.db:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.db.commit()
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.db:
+                self.db.execute("DELETE FROM responses")
+                self.db.commit()
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "persistent": self.db is not None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0
+        }
+
+MINUTE, HOUR, DAY = 60, 3600, 86400
+
+response_cache = ResponseCache(path=os.environ.get("CACHE_DB"))
+
+def parse_json(result):
+    try:
+        return json.loads(result)
+    except:
+        match = re.search(r'(\{[\s\S]*\}|\[[\s\S]*\])', result)
+        if match:
+            try:
+                return json.loads(match.group(1))
+            except:
+                pass
+        return {"raw": result}
+
+class FieldStream:
+    def __init__(self, field):
+        self.marker = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self.buffer = ""
+        self.pos = None
+        self.done = False
+    
+    def feed(self, chunk):
+        self.buffer += chunk
+        if self.done:
+            return ""
+        if self.pos is None:
+            match = self.marker.search(self.buffer)
+            if not match:
+                return ""
+            self.pos = match.end()
+        buf, i = self.buffer, self.pos
+        while i < len(buf):
+            if buf[i] == "\\":
+                step = 2
+                if buf[i + 1:i + 2] == "u":
+                    step = 12 if buf[i + 2:i + 4].lower() in ("d8", "d9", "da", "db") else 6
+                if i + step > len(buf):
+                    break
+                i += step
+            elif buf[i] == '"':
+                self.done = True
+                break
+            else:
+                i += 1
+        text = json.loads(f'"{buf[self.pos:i]}"', strict=False)
+        self.pos = i + 1 if self.done else i
+        return text
+
+# Rate Limiting
+INTERACTIVE, QUALIFY, BATCH = 0, 1, 2
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+
+class RateLimiter:
+    def __init__(self, rpm=None, tpm=None, retries=None):
+        self.rpm = rpm or max(1, int(os.environ.get("API_RPM", 50)) // WORKERS)
+        self.tpm = tpm or max(1, int(os.environ.get("API_TPM", 50000)) // WORKERS)
+        self.retries = retries if retries is not None else int(os.environ.get("API_RETRIES", 5))
+        self.requests = float(self.rpm)
+        self.tokens = float(self.tpm)
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.waiters = []
+        self.tickets = itertools.count()
+        self.cond = threading.Condition()
+        self.granted = {INTERACTIVE: 0, QUALIFY: 0, BATCH: 0}
+        self.throttled = 0
+        self.rate_limited = 0
+        self.retried = 0
+    
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+    
+    def wait_time(self, tokens):
+        waits = [self.blocked_until - time.monotonic()]
+        if self.requests < 1:
+            waits.append((1 - self.requests) * 60 / self.rpm)
+        if self.tokens < tokens:
+            waits.append((tokens - self.tokens) * 60 / self.tpm)
+        return max(waits)
+    
+    def acquire(self, priority, tokens):
+        tokens = min(tokens, self.tpm)
+        with self.cond:
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(self.waiters, ticket)
+            try:
+                waited = False
+                while True:
+                    self.refill()
+                    wait = self.wait_time(tokens) if self.waiters[0] == ticket else 1.0
+                    if wait <= 0:
+                        heapq.heappop(self.waiters)
+                        self.requests -= 1
+                        self.tokens -= tokens
+                        self.granted[priority] += 1
+                        self.throttled += waited
+                        return
+                    waited = True
+                    self.cond.wait(min(wait, 1.0))
+            finally:
+                if ticket in self.waiters:
+                    self.waiters.remove(ticket)
+                    heapq.heapify(self.waiters)
+                self.cond.notify_all()
+    
+    def settle(self, estimate, usage):
+        actual = (getattr(usage, "input_tokens", 0) or 0) + (getattr(usage, "output_tokens", 0) or 0)
+        with self.cond:
+            self.tokens = min(self.tpm, self.tokens + estimate - actual)
+    
+    def observe(self, headers):
+        with self.cond:
+            self.refill()
+            for kind, limit_attr, level_attr in (("requests", "rpm", "requests"), ("tokens", "tpm", "tokens")):
+                limit = headers.get(f"anthropic-ratelimit-{kind}-limit")
+                remaining = headers.get(f"anthropic-ratelimit-{kind}-remaining")
+                if limit and limit.isdigit():
+                    setattr(self, limit_attr, max(1, int(limit) // WORKERS))
+                if remaining and remaining.isdigit():
+                    setattr(self, level_attr, min(getattr(self, level_attr), float(remaining)))
+            retry_after = headers.get("retry-after")
+            if retry_after:
+                try:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + float(retry_after))
+                except ValueError:
+                    pass
+            self.cond.notify_all()
+    
+    def backoff(self, error, attempt):
+        status = getattr(error, "status_code", None)
+        retryable = isinstance(error, anthropic.APIConnectionError) or status in (408, 409, 429, 529) or (status or 0) >= 500
+        if not retryable or attempt >= self.retries:
+            return False
+        response = getattr(error, "response", None)
+        if response is not None:
+            self.observe(response.headers)
+        if status in (429, 529):
+            self.rate_limited += 1
+        self.retried += 1
+        time.sleep(random.uniform(0, min(30, 0.5 * 2 ** attempt)))
+        return True
+    
+    @staticmethod
+    def estimate(params):
+        return len(compact(params.get("system", "")) + compact(params["messages"])) // 4 + params["max_tokens"] // 4
+    
+    def create(self, params, priority=BATCH):
+        estimate = self.estimate(params)
+        for attempt in itertools.count():
+            self.acquire(priority, estimate)
+            try:
+                raw = client.messages.with_raw_response.create(**params)
+            except anthropic.APIError as e:
+                if self.backoff(e, attempt):
+                    continue
+                raise
+            self.observe(raw.headers)
+            response = raw.parse()
+            self.settle(estimate, response.usage)
+            return response
+    
+    @contextmanager
+    def stream(self, params, priority=BATCH):
+        estimate = self.estimate(params)
+        for attempt in itertools.count():
+            self.acquire(priority, estimate)
+            started = False
+            try:
+                with client.messages.stream(**params) as stream:
+                    started = True
+                    self.observe(stream.response.headers)
+                    yield stream
+                    self.settle(estimate, stream.get_final_message().usage)
+                return
+            except anthropic.APIError as e:
+                if started or not self.backoff(e, attempt):
+                    raise
+    
+    def stats(self):
+        with self.cond:
+            self.refill()
+            return {
+                "rpm": self.rpm,
+                "tpm": self.tpm,
+                "requests_available": round(self.requests, 2),
+                "tokens_available": round(self.tokens),
+                "waiting": len(self.waiters),
+                "granted": {"interactive": self.granted[INTERACTIVE], "qualify": self.granted[QUALIFY], "batch": self.granted[BATCH]},
+                "throttled": self.throttled,
+                "rate_limited": self.rate_limited,
+                "retried": self.retried
+            }
+
+scheduler = RateLimiter()
+
+# Metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+MODEL_PRICES = [
+    ("claude-3-haiku", 0.25, 1.25),
+    ("haiku", 0.80, 4.00),
+    ("sonnet", 3.00, 15.00),
+    ("opus", 15.00, 75.00)
+]
+
+def label_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+class Counter:
+    kind = "counter"
+    
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+    
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+    
+    def lines(self):
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{label_text(dict(zip(self.labels, labels)))} {value:g}"
+
+class Gauge(Counter):
+    kind = "gauge"
+    
+    def __init__(self, name, help, read, labels=()):
+        super().__init__(name, help, labels)
+        self.read = read
+    
+    def lines(self):
+        if not self.labels:
+            yield f"{self.name} {self.read():g}"
+            return
+        for labels, value in sorted(self.read().items()):
+            yield f"{self.name}{label_text(dict(zip(self.labels, labels)))} {value:g}"
+
+class Histogram(Counter):
+    kind = "histogram"
+    
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+    
+    def observe(self, *labels, value):
+        counts, total, count = self.values.get(labels) or ([0] * len(self.buckets), 0, 0)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[labels] = (counts, total + value, count + 1)
+    
+    def lines(self):
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            base = dict(zip(self.labels, labels))
+            for bound, n in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{label_text({**base, 'le': f'{bound:g}'})} {n}"
+            yield f"{self.name}_bucket{label_text({**base, 'le': '+Inf'})} {count}"
+            yield f"{self.name}_sum{label_text(base)} {total:g}"
+            yield f"{self.name}_count{label_text(base)} {count}"
+
+class Metrics:
+    def __init__(self):
+        self.registry = []
+        self.agent_seconds = self.add(Histogram("agent_request_seconds", "Anthropic API latency per agent", ("agent",)))
+        self.agent_tokens = self.add(Counter("agent_tokens_total", "Tokens used per agent", ("agent", "type")))
+        self.agent_stops = self.add(Counter("agent_stop_reasons_total", "Completion stop reasons per agent", ("agent", "reason")))
+        self.agent_cache = self.add(Counter("agent_cache_total", "Response cache lookups per agent", ("agent", "result")))
+        self.agent_cost = self.add(Counter("agent_cost_dollars_total", "Estimated API cost per agent", ("agent",)))
+        self.endpoint_tokens = self.add(Counter("endpoint_tokens_total", "Tokens used per endpoint", ("endpoint", "type")))
+        self.endpoint_cost = self.add(Counter("endpoint_cost_dollars_total", "Estimated API cost per endpoint", ("endpoint",)))
+        self.http_seconds = self.add(Histogram("http_request_seconds", "Time to response headers per route", ("endpoint", "method", "status")))
+        self.stage_seconds = self.add(Histogram("build_stage_seconds", "Build pipeline stage duration", ("stage",)))
+        self.shard_continuations = self.add(Counter("shard_continuations_total", "Follow-up calls for cut-off or short shards", ("site",)))
+        self.retrievals = self.add(Counter("answer_retrievals_total", "Local answer index lookups", ("kind", "result")))
+    
+    def add(self, metric):
+        self.registry.append(metric)
+        return metric
+    
+    def observe_call(self, agent, model, response, seconds):
+        usage = response.usage
+        origin = current_origin()
+        self.agent_seconds.observe(agent.name, value=seconds)
+        self.agent_stops.inc(agent.name, response.stop_reason or "unknown")
+        tokens = {
+            "input": getattr(usage, "input_tokens", 0) or 0,
+            "output": getattr(usage, "output_tokens", 0) or 0,
+            "cache_read": getattr(usage, "cache_read_input_tokens", 0) or 0,
+            "cache_write": getattr(usage, "cache_creation_input_tokens", 0) or 0
+        }
+        for kind, count in tokens.items():
+            self.agent_tokens.inc(agent.name, kind, amount=count)
+            self.endpoint_tokens.inc(origin, kind, amount=count)
+        cost = call_cost(model, tokens)
+        self.agent_cost.inc(agent.name, amount=cost)
+        self.endpoint_cost.inc(origin, amount=cost)
+    
+    def render(self):
+        lines = []
+        for metric in self.registry:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.lines())
+        return "\n".join(lines) + "\n"
+
+def call_cost(model, tokens):
+    for family, input_price, output_price in MODEL_PRICES:
+        if family in model:
+            return (tokens["input"] * input_price + tokens["output"] * output_price
+                    + tokens["cache_write"] * input_price * 1.25 + tokens["cache_read"] * input_price * 0.1) / 1e6
+    return 0
+
+def current_origin():
+    origin = getattr(gevent.getcurrent(), "origin", None)
+    if origin:
+        return origin
+    if has_request_context():
+        return request.endpoint or "unknown"
+    return "background"
+
+metrics = Metrics()
+metrics.add(Gauge("response_cache_entries", "Entries in the in-memory response cache", lambda: len(response_cache.entries)))
+metrics.add(Gauge("rate_limiter_waiting", "Calls waiting for an API rate-limit slot", lambda: len(scheduler.waiters)))
+
+# Structured Output
+STRUCTURED_OUTPUT = os.environ.get("STRUCTURED_OUTPUT", "1") != "0"
+REPAIR_ATTEMPTS = int(os.environ.get("REPAIR_ATTEMPTS", 1))
+parse_stats = {}
+
+def schema_for(example, root=True):
+    if isinstance(example, dict):
+        schema = {"type": "object", "properties": {k: schema_for(v, False) for k, v in example.items()}}
+        if root:
+            schema["required"] = list(example)
+        return schema
+    if isinstance(example, list):
+        return {"type": "array", "items": schema_for(example[0], False)} if example else {"type": "array"}
+    if isinstance(example, bool):
+        return {"type": "boolean"}
+    if isinstance(example, (int, float)):
+        return {"type": "number"}
+    return {"type": "string"}
+
+@lru_cache(maxsize=64)
+def example_schema(example):
+    try:
+        parsed = json.loads(example)
+    except ValueError:
+        return None
+    return schema_for(parsed) if isinstance(parsed, dict) else None
+
+def task_schema(task):
+    match = re.search(r"Return JSON:\s*(\{[\s\S]*\})\s*$", task)
+    return example_schema(match.group(1)) if match else None
+
+def validate(value, schema, path="$"):
+    kind = schema.get("type")
+    if kind == "object":
+        if not isinstance(value, dict):
+            return [f"{path} must be an object"]
+        errors = [f"{path}.{k} is missing" for k in schema.get("required", []) if k not in value]
+        for k, sub in schema.get("properties", {}).items():
+            if k in value and (value[k] is not None or k in schema.get("required", [])):
+                errors += validate(value[k], sub, f"{path}.{k}")
+        return errors
+    if kind == "array":
+        if not isinstance(value, list):
+            return [f"{path} must be an array"]
+        errors = []
+        for i, item in enumerate(value):
+            errors += validate(item, schema["items"], f"{path}[{i}]") if "items" in schema else []
+        return errors
+    if kind == "boolean" and not isinstance(value, bool):
+        return [f"{path} must be true or false"]
+    if kind == "number" and (isinstance(value, bool) or not isinstance(value, (int, float))):
+        return [f"{path} must be a number"]
+    if kind == "string" and not isinstance(value, str):
+        return [f"{path} must be a string"]
+    return []
+
+def record_parse(agent, valid, repaired=False):
+    stats = parse_stats.setdefault(agent.name, {"calls": 0, "failures": 0, "repairs": 0, "repaired": 0})
+    if repaired:
+        stats["repairs"] += 1
+        stats["repaired"] += valid
+    else:
+        stats["calls"] += 1
+        stats["failures"] += not valid
+
+def response_text(response):
+    for block in response.content:
+        if block.type == "tool_use":
+            return compact(block.input)
+    return "".join(block.text for block in response.content if block.type == "text")
+
+# Deadlines
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", 20))
+
+class DeadlineExceeded(Exception):
+    pass
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+# Agent Profiles
+BUDGET_MIN_SAMPLES = int(os.environ.get("BUDGET_MIN_SAMPLES", 20))
+BUDGET_HEADROOM = float(os.environ.get("BUDGET_HEADROOM", 1.5))
+BUDGET_FLOOR = int(os.environ.get("BUDGET_FLOOR", 256))
+
+DEFAULT_PROFILES = {
+    "default": {"model": os.environ.get("AGENT_MODEL", "claude-3-haiku-20240307"), "max_tokens": 4096, "adaptive": True},
+    "Researcher.pricing": {"max_tokens": 1024},
+    "LeadQualifier": {"max_tokens": 1024},
+    "SalesCloser": {"max_tokens": 1024},
+    "SupportAgent": {"max_tokens": 1024}
+}
+
+def load_profiles():
+    profiles = {name: dict(profile) for name, profile in DEFAULT_PROFILES.items()}
+    sources = []
+    path = os.environ.get("AGENT_PROFILES_FILE")
+    if path and os.path.exists(path):
+        with open(path) as f:
+            sources.append(json.load(f))
+    if os.environ.get("AGENT_PROFILES"):
+        sources.append(json.loads(os.environ["AGENT_PROFILES"]))
+    for source in sources:
+        for name, profile in source.items():
+            profiles.setdefault(name, {}).update(profile)
+    return profiles
+
+profiles = load_profiles()
+
+class OutputBudget:
+    def __init__(self, cap):
+        self.cap = cap
+        self.samples = deque(maxlen=200)
+        self.truncated = 0
+        self.extended = 0
+    
+    def limit(self, adaptive=True):
+        if not adaptive or len(self.samples) < BUDGET_MIN_SAMPLES:
+            return self.cap
+        return min(self.cap, max(BUDGET_FLOOR, int(percentile(self.samples, 99) * BUDGET_HEADROOM)))
+    
+    def observe(self, response):
+        if response.stop_reason == "max_tokens":
+            self.truncated += 1
+            return True
+        self.samples.append(response.usage.output_tokens)
+        return False
+    
+    def stats(self):
+        return {
+            "cap": self.cap,
+            "limit": self.limit(),
+            "p50_output": percentile(self.samples, 50),
+            "p99_output": percentile(self.samples, 99),
+            "samples": len(self.samples),
+            "truncated": self.truncated,
+            "extended": self.extended
+        }
+
 class Agent:
-    def __init__(self, name, system_prompt):
+    def __init__(self, name, system_prompt, cache_ttl=None, priority=BATCH, timeout=None, hedge=False):
         self.name = name
         self.system_prompt = system_prompt
+        self.priority = priority
+        self.budgets = {}
+        self.timeout = float(os.environ.get(f"AGENT_TIMEOUT_{name.upper()}", timeout or os.environ.get("AGENT_TIMEOUT", 120)))
+        self.hedge = hedge
+        self.latencies = deque(maxlen=200)
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.deadlines_exceeded = 0
+        self.cache_ttl = cache_ttl if cache_ttl is not None else int(os.environ.get("CACHE_TTL", 3600))
+    
+    def profile(self, site=None):
+        profile = {}
+        for name in ("default", self.name, f"{self.name}.{site}" if site else None):
+            profile.update(profiles.get(name, {}))
+        return profile
     
-    def run(self, task, context=""):
+    def budget(self, site=None):
+        if site not in self.budgets:
+            self.budgets[site] = OutputBudget(self.profile(site)["max_tokens"])
+        return self.budgets[site]
+    
+    def params(self, task, context="", shared=None, site=None, adaptive=True):
         prompt = f"Context:\n{context}\n\nTask:\n{task}" if context else task
-        response = client.messages.create(
-            model="claude-3-haiku-20240307",
-            max_tokens=4096,
-            system=self.system_prompt,
-            messages=[{"role": "user", "content": prompt}]
-        )
-        return response.content[0].text
-    
-    def run_json(self, task, context=""):
-        result = self.run(task + "\n\nRespond with valid JSON only.", context)
+        system = f"{self.system_prompt}\n\n{shared}" if shared else self.system_prompt
+        profile = self.profile(site)
+        params = {
+            "model": profile["model"],
+            "max_tokens": self.budget(site).limit(adaptive and profile.get("adaptive", True)),
+            "system": system,
+            "messages": [{"role": "user", "content": prompt}]
+        }
+        if profile.get("temperature") is not None:
+            params["temperature"] = profile["temperature"]
+        if profile.get("stop_sequences"):
+            params["stop_sequences"] = profile["stop_sequences"]
+        return params
+    
+    def cache_key(self, params, cache=True):
+        if not (cache and self.cache_ttl and response_cache):
+            return None
+        return response_cache.key({k: v for k, v in params.items() if k != "max_tokens"})
+    
+    def complete(self, params, cache=True, site=None):
+        key = self.cache_key(params, cache)
+        if key:
+            cached = response_cache.get(key)
+            metrics.agent_cache.inc(self.name, "miss" if cached is None else "hit")
+            if cached is not None:
+                return cached, key, "end_turn"
+        budget = self.budget(site)
+        while True:
+            start = time.monotonic()
+            response = self.call(params)
+            metrics.observe_call(self, params["model"], response, time.monotonic() - start)
+            record_context(self, usage=response.usage)
+            if not budget.observe(response) or params["max_tokens"] >= budget.cap:
+                break
+            print(f"{self.name}: output hit the learned {params['max_tokens']}-token budget, retrying at {budget.cap}")
+            budget.extended += 1
+            params = {**params, "max_tokens": budget.cap}
+        text = response_text(response)
+        if key and response.stop_reason in ("end_turn", "tool_use", "stop_sequence"):
+            response_cache.set(key, text, self.cache_ttl)
+        return text, key, response.stop_reason
+    
+    def hedge_delay(self):
+        if not self.hedge or len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return percentile(self.latencies, 95)
+    
+    def deadline(self):
+        return DeadlineExceeded(f"{self.name} did not answer within {self.timeout:g}s")
+    
+    def attempt(self, params):
         try:
-            return json.loads(result)
-        except:
-            match = re.search(r'(\{[\s\S]*\}|\[[\s\S]*\])', result)
-            if match:
-                try:
-                    return json.loads(match.group(1))
-                except:
-                    pass
-            return {"raw": result}
+            return True, scheduler.create(params, self.priority)
+        except Exception as e:
+            return False, e
+    
+    def call(self, params):
+        start = time.monotonic()
+        attempts = {}
+        try:
+            with gevent.Timeout(self.timeout, self.deadline()):
+                attempts[gevent.spawn(self.attempt, params)] = False
+                delay = self.hedge_delay()
+                if delay is not None and not gevent.wait(list(attempts), timeout=delay):
+                    attempts[gevent.spawn(self.attempt, params)] = True
+                    self.hedged += 1
+                error = None
+                while attempts:
+                    for attempt in gevent.wait(list(attempts), count=1):
+                        hedge = attempts.pop(attempt)
+                        ok, value = attempt.value
+                        if ok:
+                            self.hedge_wins += hedge
+                            self.latencies.append(time.monotonic() - start)
+                            return value
+                        error = error or value
+                raise error
+        except DeadlineExceeded:
+            self.deadlines_exceeded += 1
+            raise
+        finally:
+            gevent.killall(list(attempts), block=False)
+    
+    def stats(self):
+        return {
+            "priority": self.priority,
+            "timeout": self.timeout,
+            "hedge": self.hedge,
+            "p50": percentile(self.latencies, 50),
+            "p95": percentile(self.latencies, 95),
+            "samples": len(self.latencies),
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "deadlines_exceeded": self.deadlines_exceeded,
+            "model": self.profile()["model"],
+            "budgets": {site or "default": budget.stats() for site, budget in self.budgets.items()}
+        }
+    
+    def run(self, task, context="", cache=True, shared=None, site=None):
+        return self.complete(self.params(task, context, shared, site), cache, site)[0]
+    
+    def run_json(self, task, context="", cache=True, shared=None, schema=None, site=None):
+        return self.complete_json(task, context, cache, shared, schema, site)[0]
+    
+    def complete_json(self, task, context="", cache=True, shared=None, schema=None, site=None):
+        schema = schema or task_schema(task)
+        if not STRUCTURED_OUTPUT or not schema:
+            text, _, stop_reason = self.complete(self.params(task + "\n\nRespond with valid JSON only.", context, shared, site), cache, site)
+            return parse_json(text), stop_reason
+        
+        params = self.params(task, context, shared, site)
+        params["tools"] = [{"name": "respond", "description": "Return the result.", "input_schema": schema}]
+        params["tool_choice"] = {"type": "tool", "name": "respond"}
+        text, key, stop_reason = self.complete(params, cache, site)
+        result = parse_json(text)
+        errors = validate(result, schema)
+        record_parse(self, not errors)
+        if stop_reason == "max_tokens":
+            return result, stop_reason
+        
+        for _ in range(REPAIR_ATTEMPTS if errors else 0):
+            if key:
+                response_cache.discard(key)
+            print(f"{self.name}: invalid output ({'; '.join(errors[:3])}), repairing")
+            repair = f"""{task}
+
+Your previous answer failed validation:
+{chr(10).join('- ' + e for e in errors[:20])}
+
+Previous answer:
+{text}
+
+Return the complete, corrected result."""
+            params = {**params, "messages": [{"role": "user", "content": repair}]}
+            text, key, stop_reason = self.complete(params, cache=False, site=site)
+            result = parse_json(text)
+            errors = validate(result, schema)
+            record_parse(self, not errors, repaired=True)
+            if not errors:
+                break
+        return result, stop_reason
+    
+    def stream(self, task, context="", cache=True, shared=None, site=None):
+        params = self.params(task, context, shared, site, adaptive=False)
+        key = self.cache_key(params, cache)
+        cached = response_cache.get(key) if key else None
+        if key:
+            metrics.agent_cache.inc(self.name, "miss" if cached is None else "hit")
+        if cached is not None:
+            yield cached
+            return
+        start = time.monotonic()
+        chunks = []
+        first_token = gevent.Timeout.start_new(self.timeout, self.deadline())
+        try:
+            with scheduler.stream(params, self.priority) as stream:
+                for text in stream.text_stream:
+                    first_token.cancel()
+                    chunks.append(text)
+                    yield text
+                response = stream.get_final_message()
+        except DeadlineExceeded:
+            self.deadlines_exceeded += 1
+            raise
+        finally:
+            first_token.cancel()
+        metrics.observe_call(self, params["model"], response, time.monotonic() - start)
+        record_context(self, usage=response.usage)
+        self.budget(site).observe(response)
+        if key and response.stop_reason in ("end_turn", "stop_sequence"):
+            response_cache.set(key, "".join(chunks), self.cache_ttl)
+    
+    def stream_json(self, task, context="", cache=True, shared=None, field="response", site=None):
+        fields = FieldStream(field)
+        for chunk in self.stream(task + "\n\nRespond with valid JSON only.", context, cache, shared, site):
+            text = fields.feed(chunk)
+            if text:
+                yield "token", text
+        yield "done", parse_json(fields.buffer)
 
 # Research Agents
-researcher = Agent("Researcher", """You are an expert market researcher. Find specific opportunities with real demand. Include exact platforms, price points, and buyer behaviors. Always return actionable, specific insights.""")
+researcher = Agent("Researcher", """You are an expert market researcher. Find specific opportunities with real demand. Include exact platforms, price points, and buyer behaviors. Always return actionable, specific insights.""", cache_ttl=DAY)
 
-competitor_analyst = Agent("CompetitorAnalyst", """You analyze competitors to find gaps. Identify what sells, at what price, and what's missing. Be specific about opportunities to differentiate.""")
+competitor_analyst = Agent("CompetitorAnalyst", """You analyze competitors to find gaps. Identify what sells, at what price, and what's missing. Be specific about opportunities to differentiate.""", cache_ttl=DAY)
 
-audience_profiler = Agent("AudienceProfiler", """You create detailed buyer personas. Include demographics, pain points, desires, and buying triggers. Use exact language your target audience uses.""")
+audience_profiler = Agent("AudienceProfiler", """You create detailed buyer personas. Include demographics, pain points, desires, and buying triggers. Use exact language your target audience uses.""", cache_ttl=DAY)
 
 # Product Agents
-product_creator = Agent("ProductCreator", """You design digital products that sell. Create practical, immediately usable templates and guides. Focus on solving one specific problem completely.""")
+product_creator = Agent("ProductCreator", """You design digital products that sell. Create practical, immediately usable templates and guides. Focus on solving one specific problem completely.""", cache_ttl=DAY)
 
-copywriter = Agent("Copywriter", """You write sales copy that converts. Hook attention, agitate problems, present solutions, stack value. Write conversationally. Every sentence earns the next.""")
+copywriter = Agent("Copywriter", """You write sales copy that converts. Hook attention, agitate problems, present solutions, stack value. Write conversationally. Every sentence earns the next.""", cache_ttl=DAY)
 
 # Marketing Agents
-content_creator = Agent("ContentCreator", """You create engaging social media content. Hook in first line, provide value, lead to product naturally. Optimize for each platform.""")
+content_creator = Agent("ContentCreator", """You create engaging social media content. Hook in first line, provide value, lead to product naturally. Optimize for each platform.""", cache_ttl=DAY)
 
-email_writer = Agent("EmailWriter", """You write email sequences that convert. Compelling subjects, hooks that grab, stories that sell. Clear single CTAs. Build trust before pitching.""")
+email_writer = Agent("EmailWriter", """You write email sequences that convert. Compelling subjects, hooks that grab, stories that sell. Clear single CTAs. Build trust before pitching.""", cache_ttl=DAY)
 
-lead_generator = Agent("LeadGenerator", """You create lead magnets and funnels. Design quick wins that create desire for main product. Map the journey from stranger to buyer.""")
+lead_generator = Agent("LeadGenerator", """You create lead magnets and funnels. Design quick wins that create desire for main product. Map the journey from stranger to buyer.""", cache_ttl=DAY)
 
 # Sales Agents
-lead_qualifier = Agent("LeadQualifier", """You qualify leads and personalize outreach. Score intent, recommend actions, write personalized responses. Be helpful, not pushy.""")
+lead_qualifier = Agent("LeadQualifier", """You qualify leads and personalize outreach. Score intent, recommend actions, write personalized responses. Be helpful, not pushy.""", cache_ttl=HOUR, priority=QUALIFY, timeout=60)
 
-sales_closer = Agent("SalesCloser", """You handle sales conversations. Identify needs, match benefits, handle objections, ask for sale. Solve problems, don't pressure.""")
+sales_closer = Agent("SalesCloser", """You handle sales conversations. Identify needs, match benefits, handle objections, ask for sale. Solve problems, don't pressure.""", cache_ttl=5 * MINUTE, priority=INTERACTIVE, timeout=30, hedge=True)
 
-support_agent = Agent("SupportAgent", """You handle customer support. Resolve issues quickly, turn complaints into opportunities. Be empathetic and solution-focused.""")
+support_agent = Agent("SupportAgent", """You handle customer support. Resolve issues quickly, turn complaints into opportunities. Be empathetic and solution-focused.""", cache_ttl=5 * MINUTE, priority=INTERACTIVE, timeout=30, hedge=True)
 
-outreach_agent = Agent("OutreachAgent", """You find and engage potential customers. Research where they hang out, craft personalized messages. Build relationships before selling.""")
+outreach_agent = Agent("OutreachAgent", """You find and engage potential customers. Research where they hang out, craft personalized messages. Build relationships before selling.""", cache_ttl=HOUR)
+
+AGENTS = [researcher, competitor_analyst, audience_profiler, product_creator, copywriter, content_creator,
+          email_writer, lead_generator, lead_qualifier, sales_closer, support_agent, outreach_agent]
 
 # Data Storage
-data = {
-    "config": {},
-    "research": {},
-    "product": {},
-    "marketing": {},
-    "leads": [],
-    "customers": [],
-    "revenue": 0,
-    "outreach": []
-}
+def empty_state():
+    return {
+        "config": {},
+        "research": {},
+        "product": {},
+        "marketing": {},
+        "leads": [],
+        "customers": [],
+        "revenue": 0,
+        "outreach": [],
+        "answers": [],
+        "schedules": {}
+    }
+
+def apply_event(state, event):
+    kind = event["type"]
+    if kind == "set":
+        state.update(event["values"])
+    elif kind in ("customer", "customers"):
+        for customer in event.get("customers") or [event["customer"]]:
+            state["customers"].append(customer)
+            try:
+                state["revenue"] += float(customer.get("price", 0) or 0)
+            except (TypeError, ValueError):
+                pass
+    elif kind == "leads":
+        state["leads"].extend(event["leads"])
+    elif kind == "requalified":
+        updates = {lead_key(lead): lead for lead in event["leads"]}
+        found = set()
+        for i, lead in enumerate(state["leads"]):
+            key = lead_key(lead)
+            if key in updates:
+                state["leads"][i] = updates[key]
+                found.add(key)
+        state["leads"].extend(lead for key, lead in updates.items() if key not in found)
+    elif kind == "outreach":
+        state["outreach"].append(event["entry"])
+    elif kind == "answers":
+        state.setdefault("answers", []).append(event["entry"])
+    elif kind == "schedule":
+        state.setdefault("schedules", {}).setdefault(event["task"], {}).update(event["values"])
+    else:
+        raise ValueError(f"Unknown event type: {kind}")
+
+# Aggregates
+class Aggregates:
+    def __init__(self):
+        self.revenue_by_source = {}
+        self.sales_by_source = {}
+        self.hourly = {}
+        self.daily = {}
+        self.lead_scores = {score: 0 for score in range(11)}
+        self.lead_index = {}
+        self.sales = 0
+        self.leads = 0
+    
+    @classmethod
+    def from_state(cls, state):
+        aggregates = cls()
+        for customer in state.get("customers", []):
+            aggregates.add_sale(customer)
+        for lead in state.get("leads", []):
+            aggregates.add_lead(lead)
+        return aggregates
+    
+    def apply(self, event):
+        if event["type"] in ("customer", "customers"):
+            for customer in event.get("customers") or [event["customer"]]:
+                self.add_sale(customer)
+        elif event["type"] in ("leads", "requalified"):
+            for lead in event["leads"]:
+                self.add_lead(lead)
+    
+    def bucket(self, when, field, amount=1):
+        for buckets, key in ((self.hourly, when[:13]), (self.daily, when[:10])):
+            counts = buckets.setdefault(key, {"sales": 0, "revenue": 0, "leads": 0})
+            counts[field] += amount
+    
+    def add_sale(self, customer):
+        try:
+            price = float(customer.get("price", 0) or 0)
+        except (TypeError, ValueError):
+            price = 0
+        source = customer.get("source", "unknown")
+        self.sales += 1
+        self.sales_by_source[source] = self.sales_by_source.get(source, 0) + 1
+        self.revenue_by_source[source] = round(self.revenue_by_source.get(source, 0) + price, 2)
+        when = customer.get("time", "")
+        self.bucket(when, "sales")
+        self.bucket(when, "revenue", price)
+    
+    def add_lead(self, lead):
+        key = lead_key(lead)
+        previous, when = self.lead_index.get(key) if key[1] else None, lead.get("processed", "")
+        if previous is None:
+            self.leads += 1
+            previous = None, None
+        try:
+            score = min(10, max(0, int(float(lead.get("score")))))
+        except (TypeError, ValueError):
+            score = previous[0]
+        if previous[0] is not None:
+            self.lead_scores[previous[0]] -= 1
+        if score is not None:
+            self.lead_scores[score] += 1
+        if previous[1] is not None:
+            self.bucket(previous[1], "leads", -1)
+        self.bucket(when, "leads")
+        if key[1]:
+            self.lead_index[key] = score, when
+    
+    def totals(self):
+        return {
+            "sales_by_source": self.sales_by_source,
+            "revenue_by_source": self.revenue_by_source,
+            "lead_scores": self.lead_scores,
+            "conversion_rate": round(self.sales / self.leads, 4) if self.leads else 0
+        }
+    
+    def query(self, start, end, bucket="day"):
+        if bucket not in ("hour", "day"):
+            raise ValueError(f"Invalid bucket: {bucket!r} (use hour or day)")
+        buckets, step, width = (self.hourly, timedelta(hours=1), 13) if bucket == "hour" else (self.daily, timedelta(days=1), 10)
+        if (end - start) / step > MAX_STAT_BUCKETS:
+            raise ValueError(f"Range too large: at most {MAX_STAT_BUCKETS} {bucket} buckets")
+        series = []
+        totals = {"sales": 0, "revenue": 0, "leads": 0}
+        when = start
+        while when <= end:
+            key = when.isoformat()[:width]
+            counts = buckets.get(key, {"sales": 0, "revenue": 0, "leads": 0})
+            series.append({"bucket": key, **counts, "revenue": round(counts["revenue"], 2)})
+            for field in totals:
+                totals[field] += counts[field]
+            when += step
+        totals["revenue"] = round(totals["revenue"], 2)
+        totals["conversion_rate"] = round(totals["sales"] / totals["leads"], 4) if totals["leads"] else 0
+        return {"from": start.isoformat(), "to": end.isoformat(), "bucket": bucket, "totals": totals, "series": series}
+
+MAX_STAT_BUCKETS = int(os.environ.get("MAX_STAT_BUCKETS", 2000))
+
+def local_time(value):
+    when = datetime.fromisoformat(value)
+    return when.astimezone().replace(tzinfo=None) if when.tzinfo else when
+
+# Lead Index
+LEAD_URGENCIES = ("hot", "warm", "cold")
+
+def lead_key(lead):
+    return norm(lead.get("type")), norm(lead.get("identifier"))
+
+class LeadStore:
+    def __init__(self):
+        self.leads = {}
+        self.order = {}
+        self.entries = {}
+        self.buckets = {}
+        self.merges = 0
+        self.loading = False
+    
+    @classmethod
+    def from_state(cls, state):
+        store = cls()
+        store.loading = True
+        config = state.get("config", {})
+        store.add((state.get("initial_leads") or {}).get("leads", []), config.get("updated") or config.get("created"))
+        for entry in state.get("outreach", []):
+            store.add((entry.get("leads") or {}).get("leads", []), entry.get("time"))
+        store.add(state.get("leads", []))
+        store.reindex()
+        return store
+    
+    def apply(self, event):
+        if event["type"] == "set" and "initial_leads" in event["values"]:
+            self.add((event["values"]["initial_leads"] or {}).get("leads", []), event["time"])
+        elif event["type"] == "outreach":
+            self.add((event["entry"].get("leads") or {}).get("leads", []), event["entry"].get("time", event["time"]))
+        elif event["type"] in ("leads", "requalified"):
+            self.add(event["leads"])
+    
+    def add(self, leads, found=None):
+        for lead in leads:
+            if isinstance(lead, dict):
+                self.insert(lead, found)
+    
+    def insert(self, lead, found=None):
+        key = lead_key(lead)
+        if not key[1]:
+            return None
+        current = self.leads.get(key)
+        if current is None:
+            merged = {"found": found, **lead, "seen": 1 if found else 0}
+            self.order[key] = len(self.order)
+        else:
+            if not self.loading:
+                self.unindex(key)
+            merged = {**current, **{k: v for k, v in lead.items() if v not in (None, "") and k != "found"}}
+            merged["seen"] = current.get("seen", 0) + (1 if found else 0)
+            self.merges += 1
+        self.leads[key] = merged
+        if not self.loading:
+            self.index(key, merged)
+        return merged
+    
+    def rank(self, lead):
+        try:
+            return float(lead.get("score", lead.get("prescore", 0)) or 0)
+        except (TypeError, ValueError):
+            return 0.0
+    
+    def bucket_id(self, lead):
+        urgency = str(lead.get("urgency") or "").strip().lower()
+        return bool(lead.get("processed")), urgency if urgency in LEAD_URGENCIES else "unknown"
+    
+    def index(self, key, lead):
+        bucket, entry = self.bucket_id(lead), (-self.rank(lead), -self.order[key], key)
+        bisect.insort(self.buckets.setdefault(bucket, []), entry)
+        self.entries[key] = bucket, entry
+    
+    def reindex(self):
+        self.buckets, self.entries = {}, {}
+        for key, lead in self.leads.items():
+            bucket, entry = self.bucket_id(lead), (-self.rank(lead), -self.order[key], key)
+            self.buckets.setdefault(bucket, []).append(entry)
+            self.entries[key] = bucket, entry
+        for entries in self.buckets.values():
+            entries.sort()
+        self.loading = False
+    
+    def unindex(self, key):
+        bucket, entry = self.entries.pop(key)
+        entries = self.buckets[bucket]
+        del entries[bisect.bisect_left(entries, entry)]
+    
+    def get(self, type, identifier):
+        return self.leads.get(lead_key({"type": type, "identifier": identifier}))
+    
+    def query(self, processed=None, urgency=None, min_score=None, limit=None, offset=0):
+        ranges, total = [], 0
+        for (done, level), entries in self.buckets.items():
+            if (processed is None or done == processed) and (not urgency or level in urgency):
+                end = bisect.bisect_right(entries, (-min_score, float("inf"))) if min_score is not None else len(entries)
+                ranges.append(itertools.islice(entries, end))
+                total += end
+        merged = heapq.merge(*ranges)
+        stop = None if limit is None else offset + limit
+        return [self.leads[key] for _, _, key in itertools.islice(merged, offset, stop)], total
+    
+    def unprocessed(self):
+        return self.query(processed=False)[0]
+    
+    def stats(self):
+        counts = {}
+        for (done, level), entries in self.buckets.items():
+            if entries:
+                counts.setdefault("processed" if done else "unprocessed", {})[level] = len(entries)
+        return {"total": len(self.leads), "merges": self.merges, "by_state": counts}
+
+class Store:
+    def __init__(self, snapshot_path, log_path):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.data = empty_state()
+        self.seq = 0
+        self.durable_seq = 0
+        self.snapshot_seq = 0
+        self.log = None
+        self.log_bytes = 0
+        self.log_inode = None
+        self.lock_file = None
+        self.snapshot_size = 0
+        self.flusher = None
+        self.event_ids = set()
+        self.aggregates = Aggregates()
+        self.leads = LeadStore()
+        self.versions = {}
+        self.listeners = []
+        self.publishers = []
+        self.flush_interval = int(os.environ.get("EVENT_FLUSH_MS", 50)) / 1000
+        self.snapshot_every = int(os.environ.get("SNAPSHOT_EVERY", 1000))
+        self.snapshot_bytes = int(os.environ.get("SNAPSHOT_BYTES", 8 * 1024 * 1024))
+        self.lock = threading.RLock()
+        self.durable = threading.Condition(self.lock)
+    
+    def flock(self, mode):
+        delay = 0.001
+        while True:
+            try:
+                return fcntl.flock(self.lock_file, mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                gevent.sleep(delay)
+                delay = min(delay * 2, 0.05)
+    
+    @contextmanager
+    def shared(self, exclusive=False):
+        with self.lock:
+            self.flock(fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                self.catch_up(exclusive)
+                yield
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+    
+    def load(self):
+        with self.lock:
+            self.lock_file = open(self.log_path + ".lock", "a")
+            with self.shared(exclusive=True):
+                pass
+        self.flusher = gevent.spawn(self.flush_loop)
+    
+    def load_state(self, repair=False):
+        state, seq, versions = empty_state(), 0, {}
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            if "seq" in snapshot and "data" in snapshot:
+                state, seq, versions = snapshot["data"], snapshot["seq"], snapshot.get("versions", {})
+            else:
+                state = snapshot
+            print("Loaded existing data")
+        except FileNotFoundError:
+            print("Starting fresh")
+        self.snapshot_seq = seq
+        if self.log:
+            self.log.close()
+        self.log = open(self.log_path, "ab")
+        self.log_inode = os.fstat(self.log.fileno()).st_ino
+        replayed, offset = 0, 0
+        with open(self.log_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    break
+                offset += len(line)
+                if event["seq"] > seq:
+                    apply_event(state, event)
+                    seq = event["seq"]
+                    if event["type"] == "set":
+                        versions.update((key, seq) for key in event["values"])
+                    replayed += 1
+        if replayed:
+            print(f"Replayed {replayed} events")
+        self.data.clear()
+        self.data.update(state)
+        self.event_ids = {c["event_id"] for c in state["customers"] if c.get("event_id")}
+        self.aggregates = Aggregates.from_state(state)
+        self.leads = LeadStore.from_state(state)
+        self.versions = versions
+        self.seq = self.durable_seq = seq
+        self.log_bytes = offset
+        self.snapshot_size = os.path.getsize(self.snapshot_path) if os.path.exists(self.snapshot_path) else 0
+        if repair:
+            self.repair_tail()
+    
+    def repair_tail(self):
+        size = os.path.getsize(self.log_path)
+        if size > self.log_bytes:
+            os.truncate(self.log_path, self.log_bytes)
+            print(f"Truncated {size - self.log_bytes} bytes of torn event log")
+    
+    def catch_up(self, exclusive=False):
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or stat.st_ino != self.log_inode:
+            self.load_state(repair=exclusive)
+            return
+        if stat.st_size <= self.log_bytes:
+            return
+        with open(self.log_path, "rb") as f:
+            f.seek(self.log_bytes)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    break
+                self.log_bytes += len(line)
+                if event["seq"] > self.seq:
+                    self.apply(event)
+        if exclusive:
+            self.repair_tail()
+    
+    def refresh(self):
+        with self.shared():
+            pass
+    
+    def apply(self, event):
+        apply_event(self.data, event)
+        self.aggregates.apply(event)
+        self.leads.apply(event)
+        self.seq = event["seq"]
+        if event["type"] == "set":
+            self.versions.update((key, self.seq) for key in event["values"])
+        if event["type"] == "customers":
+            self.event_ids.update(c["event_id"] for c in event["customers"] if c.get("event_id"))
+        for listener in self.listeners:
+            listener(event)
+    
+    def record(self, kind, sync=False, check=None, **payload):
+        with self.lock:
+            with self.shared(exclusive=True):
+                if check and not check(self.data):
+                    return None
+                if kind == "customers":
+                    payload["customers"] = [c for c in payload["customers"] if not c.get("event_id") or c["event_id"] not in self.event_ids]
+                    if not payload["customers"]:
+                        return None
+                event = {"seq": self.seq + 1, "type": kind, "time": datetime.now().isoformat(), **payload}
+                self.apply(event)
+                line = (compact(event) + "\n").encode()
+                self.log.write(line)
+                self.log.flush()
+                self.log_bytes += len(line)
+                for publish in self.publishers:
+                    publish(event)
+                compacted = self.seq - self.snapshot_seq >= self.snapshot_every or self.log_bytes >= self.snapshot_bytes
+                if compacted:
+                    self.compact_log()
+            if sync and not compacted:
+                self.durable.wait_for(lambda: self.durable_seq >= event["seq"])
+        return event
+    
+    def sync(self):
+        with self.lock:
+            if self.log and self.durable_seq < self.seq:
+                self.log.flush()
+                os.fsync(self.log.fileno())
+                self.durable_seq = self.seq
+                self.durable.notify_all()
+    
+    def flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.sync()
+    
+    def compact_log(self):
+        tmp = self.snapshot_path + ".tmp"
+        text = compact({"seq": self.seq, "data": self.data, "versions": self.versions})
+        with open(tmp, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        open(self.log_path + ".tmp", "wb").close()
+        os.replace(self.log_path + ".tmp", self.log_path)
+        self.log.close()
+        self.log = open(self.log_path, "ab")
+        self.log_inode = os.fstat(self.log.fileno()).st_ino
+        self.log_bytes = 0
+        self.snapshot_size = len(text)
+        self.snapshot_seq = self.durable_seq = self.seq
+        self.durable.notify_all()
+    
+    def size(self):
+        return self.snapshot_size + self.log_bytes
+    
+    def close(self):
+        with self.lock:
+            with self.shared(exclusive=True):
+                if self.seq > self.snapshot_seq:
+                    self.compact_log()
+            self.log.close()
+            self.log = None
+            self.lock_file.close()
+        if self.flusher:
+            self.flusher.kill(block=False)
+
+# Published Assets
+ASSET_MAGIC = b"ASN1"
+ASSET_KEYS = ("research", "product", "marketing", "outreach_plan", "initial_leads", "context", "config")
+
+class AssetSnapshot:
+    def __init__(self, folder):
+        self.folder = folder
+        self.pointer = os.path.join(folder, "CURRENT")
+        self.inode = None
+        self.generation = None
+        self.map = None
+        self.base = 0
+        self.sections = {}
+        self.etags = {}
+    
+    def publish(self, generation, data, renders):
+        sections, etags = [], {}
+        for key in ASSET_KEYS:
+            if key in data:
+                sections.append((key, compact(data[key]).encode()))
+        for name in renders.renderers:
+            entry = renders.get(name)
+            if entry:
+                sections.append((f"render:{name}", entry[0].encode()))
+                etags[name] = entry[1]
+        index, offset = {}, 0
+        for name, body in sections:
+            index[name] = [offset, len(body)]
+            offset += len(body)
+        header = compact({"generation": generation, "sections": index, "etags": etags}).encode()
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, f"assets-{generation}.bin")
+        with open(path + ".tmp", "wb") as f:
+            f.write(ASSET_MAGIC + len(header).to_bytes(4, "little") + header)
+            for _, body in sections:
+                f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        with open(self.pointer + ".tmp", "w") as f:
+            f.write(str(generation))
+        os.replace(self.pointer + ".tmp", self.pointer)
+        for name in os.listdir(self.folder):
+            if name.startswith("assets-") and name != os.path.basename(path):
+                os.remove(os.path.join(self.folder, name))
+        self.refresh()
+    
+    def refresh(self):
+        try:
+            stat = os.stat(self.pointer)
+            if stat.st_ino == self.inode:
+                return
+            with open(self.pointer) as f:
+                generation = int(f.read())
+            with open(os.path.join(self.folder, f"assets-{generation}.bin"), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return
+        if mapped[:4] != ASSET_MAGIC:
+            return
+        size = int.from_bytes(mapped[4:8], "little")
+        header = json.loads(mapped[8:8 + size])
+        self.map, self.base = mapped, 8 + size
+        self.sections, self.etags = header["sections"], header["etags"]
+        self.generation, self.inode = header["generation"], stat.st_ino
+    
+    def raw(self, name):
+        if name not in self.sections:
+            return None
+        offset, length = self.sections[name]
+        return memoryview(self.map)[self.base + offset:self.base + offset + length]
+
+# Rendered Artifacts
+def render_product_copy(product):
+    copy = product.get("copy", {})
+    pricing = product.get("pricing", {})
+    if not copy:
+        return None
+    
+    parts = [f"""# {copy.get('headline', 'Product')}
+
+## {copy.get('subheadline', '')}
+
+{copy.get('hook', '')}
+
+---
+
+## The Problem
+
+{copy.get('problem', '')}
+
+---
+
+## The Solution
+
+{copy.get('solution', '')}
+
+---
+
+## What You Get:
+
+"""]
+    for item in copy.get('included', []):
+        parts.append(f"✅ **{item.get('item', '')}** - {item.get('benefit', '')}\n\n")
+    
+    parts.append("\n## BONUSES:\n\n")
+    for bonus in copy.get('bonuses', []):
+        parts.append(f"🎁 **{bonus.get('name', '')}** ({bonus.get('value', '')})\n\n")
+    
+    parts.append(f"""
+---
+
+## 100% Money-Back Guarantee
+
+{copy.get('guarantee', '30-day no questions asked refund')}
+
+---
+
+## FAQ
+
+""")
+    for faq in copy.get('faq', []):
+        parts.append(f"**Q: {faq.get('q', '')}**\nA: {faq.get('a', '')}\n\n")
+    
+    parts.append(f"""
+---
+
+**Launch Price: ${pricing.get('launch_price', 27)}** (Regular ${pricing.get('price', 37)})
+
+{copy.get('cta', 'Get Instant Access')}
+""")
+    return "".join(parts)
+
+def render_email_sequence(marketing):
+    emails = marketing.get("emails", {}).get("emails", [])
+    if not emails:
+        return None
+    
+    parts = ["# Email Sequence\n\n"]
+    for e in emails:
+        parts.append(f"""## Email {e.get('number', '')}
+**Send:** {e.get('send', '')}
+**Purpose:** {e.get('purpose', '')}
+**Subject:** {e.get('subject', '')}
+
+{e.get('body', '')}
+
+**CTA:** {e.get('cta', '')}
+
+---
+
+""")
+    return "".join(parts)
+
+def render_social_posts(marketing):
+    posts = marketing.get("social", {}).get("posts", [])
+    if not posts:
+        return None
+    
+    parts = ["# Social Content Calendar\n\n"]
+    for p in posts:
+        parts.append(f"""## Day {p.get('day', '')} - {p.get('platform', '').upper()}
+**Type:** {p.get('type', '')}
+
+**Hook:** {p.get('hook', '')}
+
+{p.get('body', '')}
+
+""")
+        if p.get('cta'):
+            parts.append(f"**CTA:** {p.get('cta', '')}\n")
+        if p.get('hashtags'):
+            parts.append(f"**Tags:** {' '.join(p.get('hashtags', []))}\n")
+        parts.append("\n---\n\n")
+    return "".join(parts)
+
+class RenderCache:
+    def __init__(self, store):
+        self.store = store
+        self.renderers = {}
+        self.entries = {}
+        self.renders = 0
+    
+    def register(self, name, sources, render):
+        self.renderers[name] = (sources, render)
+    
+    def versions(self, sources):
+        return tuple(self.store.versions.get(key, 0) for key in sources)
+    
+    def render(self, name):
+        sources, render = self.renderers[name]
+        versions = self.versions(sources)
+        text = render(*(self.store.data.get(key) or {} for key in sources))
+        entry = (text, f'"{hashlib.sha256(text.encode()).hexdigest()[:16]}"') if text else None
+        self.entries[name] = (versions, entry)
+        self.renders += 1
+        return entry
+    
+    def get(self, name):
+        cached = self.entries.get(name)
+        if cached and cached[0] == self.versions(self.renderers[name][0]):
+            return cached[1]
+        return self.render(name)
+    
+    def on_event(self, event):
+        if event["type"] != "set":
+            return
+        for name, (sources, _) in self.renderers.items():
+            if any(key in event["values"] for key in sources):
+                self.render(name)
+
+RENDERERS = [
+    ("product_copy", ["product"], render_product_copy),
+    ("email_sequence", ["marketing"], render_email_sequence),
+    ("social_posts", ["marketing"], render_social_posts)
+]
+
+# Webhook Ingestion
+WEBHOOK_RETRY_MAX = 30
+
+class WebhookIngest:
+    def __init__(self, store):
+        self.store = store
+        self.queue = queue.Queue(maxsize=int(os.environ.get("WEBHOOK_QUEUE", 1000)))
+        self.batch_size = int(os.environ.get("WEBHOOK_BATCH", 100))
+        self.pending = set()
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.batches = 0
+        self.committed = 0
+        self.failures = 0
+        self.retry_delay = float(os.environ.get("WEBHOOK_RETRY_SECONDS", 0.5))
+        self.drain_timeout = float(os.environ.get("WEBHOOK_DRAIN_SECONDS", 30))
+        self.greenlet = None
+    
+    def submit(self, customer):
+        event_id = customer["event_id"]
+        if event_id in self.pending or event_id in self.store.event_ids:
+            self.duplicates += 1
+            return "duplicate"
+        try:
+            self.queue.put_nowait(customer)
+        except queue.Full:
+            self.rejected += 1
+            return "busy"
+        self.pending.add(event_id)
+        self.accepted += 1
+        return "queued"
+    
+    def writer(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                if batch:
+                    self.commit(batch)
+                return
+            self.commit(batch)
+    
+    def commit(self, batch):
+        delay = self.retry_delay
+        while True:
+            try:
+                event = self.store.record("customers", sync=True, customers=batch)
+                break
+            except Exception as e:
+                self.failures += 1
+                print(f"Webhook batch of {len(batch)} failed, retrying in {delay:g}s: {e}")
+                gevent.sleep(delay)
+                delay = min(delay * 2, WEBHOOK_RETRY_MAX)
+        committed = len(event["customers"]) if event else 0
+        self.batches += 1
+        self.committed += committed
+        self.duplicates += len(batch) - committed
+        self.pending.difference_update(c["event_id"] for c in batch)
+    
+    def start(self):
+        self.greenlet = gevent.spawn(self.writer)
+    
+    def stop(self):
+        if not self.greenlet:
+            return
+        try:
+            self.queue.put(None, timeout=self.drain_timeout)
+        except queue.Full:
+            pass
+        self.greenlet.join(self.drain_timeout)
+        if not self.greenlet.dead:
+            self.greenlet.kill(block=False)
+            print(f"Dropped {len(self.pending)} uncommitted sales")
+        self.greenlet = None
+    
+    def idle(self):
+        return not self.pending and self.queue.empty()
+    
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "capacity": self.queue.maxsize,
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "committed": self.committed,
+            "batches": self.batches,
+            "failures": self.failures
+        }
+
+def webhook_event_id(source, *candidates):
+    for candidate in candidates:
+        if candidate not in (None, ""):
+            return f"{source}:{candidate}"
+    body = request.get_data() or compact(request.form.to_dict()).encode()
+    return f"{source}:sha256:{hashlib.sha256(body).hexdigest()}"
+
+def ingest(customer):
+    status = workspace().webhooks.submit(customer)
+    if status == "busy":
+        return jsonify({"status": "busy"}), 503, {"Retry-After": "5"}
+    if status == "queued":
+        print(f"💰 {customer['source'].upper()}: {customer['email']} - ${customer.get('price')}")
+    return jsonify({"status": status, "customer": customer})
+
+# Workspaces
+DEFAULT_WORKSPACE = "default"
+WORKSPACE_DIR = os.environ.get("WORKSPACE_DIR", "workspaces")
+MAX_WORKSPACES = int(os.environ.get("MAX_WORKSPACES", 16))
+WORKSPACE_MEMORY_MB = float(os.environ.get("WORKSPACE_MEMORY_MB", 256))
+WORKSPACE_ID = re.compile(r"[A-Za-z0-9][A-Za-z0-9_-]{0,63}")
+
+class UnknownWorkspace(Exception):
+    pass
+
+class Workspace:
+    def __init__(self, id, snapshot_path, log_path):
+        self.id = id
+        self.store = Store(snapshot_path, log_path)
+        self.data = self.store.data
+        self.renders = RenderCache(self.store)
+        for name, sources, render in RENDERERS:
+            self.renders.register(name, sources, render)
+        self.store.listeners.append(self.renders.on_event)
+        self.assets = AssetSnapshot(os.path.splitext(snapshot_path)[0] + "-assets")
+        self.schedule_path = schedule_index_path(snapshot_path)
+        self.store.publishers.append(self.publish)
+        self.webhooks = WebhookIngest(self.store)
+        self.indexes = {}
+        self.pins = 0
+    
+    def open(self):
+        self.store.load()
+        self.assets.refresh()
+        self.webhooks.start()
+        write_schedule_index(self.schedule_path, self.data)
+    
+    def refresh(self):
+        self.store.refresh()
+        self.assets.refresh()
+    
+    def publish(self, event):
+        if event["type"] == "set" and any(key in ASSET_KEYS for key in event["values"]):
+            self.assets.publish(event["seq"], self.data, self.renders)
+        if event["type"] == "schedule" or event["type"] == "set" and "config" in event["values"]:
+            write_schedule_index(self.schedule_path, self.data)
+    
+    def current(self, *keys):
+        return self.assets.generation is not None and all(self.assets.generation >= self.store.versions.get(key, 0) for key in keys)
+    
+    def asset(self, key):
+        return self.assets.raw(key) if key in ASSET_KEYS and self.current(key) else None
+    
+    def rendered(self, name):
+        if self.current(*self.renders.renderers[name][0]) and name in self.assets.etags:
+            return self.assets.raw(f"render:{name}"), self.assets.etags[name]
+        entry = self.renders.get(name)
+        return (entry[0].encode(), entry[1]) if entry else None
+    
+    def close(self):
+        self.webhooks.stop()
+        self.store.close()
+    
+    def idle(self):
+        return self.pins == 0 and self.webhooks.idle()
+    
+    def context(self):
+        if not self.data.get("context"):
+            self.data["context"] = build_context(self.data.get("research", {}), self.data.get("product", {}))
+        return self.data["context"]
+    
+    def answers(self, kind):
+        version = (self.store.versions.get("product", 0), len(self.data.get("answers", [])))
+        if self.indexes.get(kind, (None,))[0] != version:
+            self.indexes[kind] = (version, AnswerIndex(answer_entries(self.data, kind)))
+        return self.indexes[kind][1]
+    
+    def lead_scorer(self):
+        version = self.store.versions.get("research", 0)
+        if self.indexes.get("leads", (None,))[0] != version:
+            self.indexes["leads"] = (version, LeadScorer(self.data.get("research")))
+        scorer = self.indexes["leads"][1]
+        return scorer if scorer.vocab else None
+    
+    def summary(self):
+        return {
+            "workspace": self.id,
+            "resident": True,
+            "niche": self.data.get("config", {}).get("niche"),
+            "state_bytes": self.store.size(),
+            "seq": self.store.seq,
+            "pins": self.pins,
+            "customers": len(self.data.get("customers", [])),
+            "revenue": self.data.get("revenue", 0)
+        }
+
+class WorkspaceRegistry:
+    def __init__(self, root, max_resident=None, memory_cap=None):
+        self.root = root
+        self.max_resident = max_resident or MAX_WORKSPACES
+        self.memory_cap = (memory_cap or WORKSPACE_MEMORY_MB) * 1024 * 1024
+        self.resident = OrderedDict()
+        self.lock = threading.RLock()
+        self.loads = 0
+        self.evictions = 0
+    
+    def paths(self, id):
+        if id == DEFAULT_WORKSPACE:
+            return os.environ.get("STATE_FILE", "business.json"), os.environ.get("EVENT_LOG", "events.log")
+        folder = os.path.join(self.root, id)
+        return os.path.join(folder, "business.json"), os.path.join(folder, "events.log")
+    
+    def exists(self, id):
+        return id == DEFAULT_WORKSPACE or os.path.isdir(os.path.join(self.root, id))
+    
+    def ids(self):
+        on_disk = [name for name in os.listdir(self.root) if WORKSPACE_ID.fullmatch(name)] if os.path.isdir(self.root) else []
+        return sorted({DEFAULT_WORKSPACE, *on_disk, *self.resident})
+    
+    def acquire(self, id, create=False):
+        if not WORKSPACE_ID.fullmatch(id or ""):
+            raise UnknownWorkspace(f"Invalid workspace id: {id!r}")
+        with self.lock:
+            ws = loaded = self.resident.get(id)
+            if ws is None:
+                if not self.exists(id):
+                    if not create:
+                        raise UnknownWorkspace(f"Unknown workspace: {id}")
+                    os.makedirs(os.path.join(self.root, id), exist_ok=True)
+                ws = Workspace(id, *self.paths(id))
+                print(f"Loading workspace {id} (pid {os.getpid()})")
+                ws.open()
+                self.resident[id] = ws
+                self.loads += 1
+            self.resident.move_to_end(id)
+            ws.pins += 1
+            self.evict()
+        if loaded is not None:
+            try:
+                ws.refresh()
+            except Exception:
+                self.release(ws)
+                raise
+        return ws
+    
+    def release(self, ws):
+        with self.lock:
+            ws.pins -= 1
+            if not ws.pins:
+                self.evict()
+    
+    @contextmanager
+    def use(self, id, create=False):
+        ws = self.acquire(id, create)
+        try:
+            yield ws
+        finally:
+            self.release(ws)
+    
+    def size(self):
+        return sum(ws.store.size() for ws in self.resident.values())
+    
+    def evict(self):
+        size = self.size()
+        for ws in list(self.resident.values()):
+            if len(self.resident) <= self.max_resident and size <= self.memory_cap:
+                return
+            if not ws.idle():
+                continue
+            size -= ws.store.size()
+            del self.resident[ws.id]
+            ws.close()
+            self.evictions += 1
+            print(f"Evicted workspace {ws.id}")
+    
+    def close(self):
+        with self.lock:
+            for ws in list(self.resident.values()):
+                ws.close()
+            self.resident.clear()
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "resident": len(self.resident),
+                "max_resident": self.max_resident,
+                "state_bytes": self.size(),
+                "memory_cap_bytes": int(self.memory_cap),
+                "loads": self.loads,
+                "evictions": self.evictions
+            }
+
+workspaces = WorkspaceRegistry(WORKSPACE_DIR)
+atexit.register(workspaces.close)
+metrics.add(Gauge("workspaces_resident", "Workspaces loaded in memory", lambda: len(workspaces.resident)))
+metrics.add(Gauge("workspace_state_bytes", "Serialized state held by resident workspaces", workspaces.size))
+metrics.add(Gauge("event_log_seq", "Last event sequence number", lambda: {(id,): ws.store.seq for id, ws in workspaces.resident.items()}, ("workspace",)))
+metrics.add(Gauge("webhook_queue_depth", "Sales waiting for the background writer", lambda: {(id,): ws.webhooks.queue.qsize() for id, ws in workspaces.resident.items()}, ("workspace",)))
+
+class WorkspacePrefix:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        match = re.match(r"/w/([^/]+)(/.*)?$", environ.get("PATH_INFO", ""))
+        if match:
+            environ["workspace"] = match.group(1)
+            environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + f"/w/{match.group(1)}"
+            environ["PATH_INFO"] = match.group(2) or "/"
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = WorkspacePrefix(app.wsgi_app)
+
+def workspace_id():
+    body = request.get_json(silent=True) if request.is_json else None
+    return (request.environ.get("workspace")
+            or request.args.get("workspace")
+            or request.headers.get("X-Workspace")
+            or (body.get("workspace") if isinstance(body, dict) else None)
+            or DEFAULT_WORKSPACE)
+
+def workspace(create=False):
+    if "workspace" not in g:
+        g.workspace = workspaces.acquire(workspace_id(), create)
+    return g.workspace
+
+# Shared Context
+context_stats = {}
+
+def compact(obj):
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+def estimate_tokens(text):
+    return len(text) // 4
+
+def pick(obj, *keys):
+    if not isinstance(obj, dict):
+        return {}
+    if "raw" in obj:
+        return obj
+    return {k: obj[k] for k in keys if obj.get(k) not in (None, "", [], {})}
+
+def audience_digest(audience):
+    return pick(audience.get("persona", audience) if isinstance(audience, dict) else {},
+        "occupation", "biggest_problem", "desired_outcome", "fears", "buying_triggers", "objections", "language")
+
+def competitor_digest(competitors):
+    digest = pick(competitors, "gaps", "differentiation")
+    products = competitors.get("top_products", []) if isinstance(competitors, dict) else []
+    if products:
+        digest["top_products"] = [pick(p, "name", "price", "weaknesses", "sales_level") for p in products]
+    return digest
+
+def research_digest(research):
+    return {
+        "market": pick(research.get("market", {}), "market_size", "communities", "pricing", "demand_signals", "buyer_urgency"),
+        "competitors": competitor_digest(research.get("competitors", {})),
+        "audience": audience_digest(research.get("audience", {}))
+    }
+
+def product_summary(product):
+    summary = pick(product, "name", "tagline", "format", "promise", "time_to_result")
+    if isinstance(product, dict) and "raw" not in product:
+        for field, key in (("sections", "title"), ("bonuses", "name")):
+            names = [item.get(key) for item in product.get(field, []) if isinstance(item, dict)]
+            if names:
+                summary[field] = names
+    return summary
+
+def product_digest(bundle):
+    return {
+        **product_summary(bundle.get("product", {})),
+        **pick(bundle.get("pricing", {}), "price", "launch_price"),
+        **pick(bundle.get("copy", {}), "guarantee")
+    }
+
+def sales_digest(bundle):
+    copy = bundle.get("copy", {})
+    return {
+        **product_digest(bundle),
+        **pick(copy, "included", "faq")
+    }
+
+def build_context(research, product):
+    digests = {
+        "research": ("Research", research, research_digest(research)),
+        "product": ("Product", product, product_digest(product)),
+        "sales": ("Product", product, sales_digest(product))
+    }
+    ctx = {"tokens_saved": {}}
+    for kind, (label, source, digest) in digests.items():
+        ctx[kind] = f"{label}: {compact(digest)}"
+        ctx["tokens_saved"][kind] = estimate_tokens(json.dumps(source, indent=2)) - estimate_tokens(ctx[kind])
+    return ctx
+
+def record_context(agent, saved=0, usage=None):
+    stats = context_stats.setdefault(agent.name, {
+        "calls": 0,
+        "tokens_saved": 0,
+        "input_tokens": 0
+    })
+    stats["tokens_saved"] += saved
+    if usage is not None:
+        stats["calls"] += 1
+        stats["input_tokens"] += getattr(usage, "input_tokens", 0) or 0
+
+def embed(agent, payload, digest=None):
+    text = compact(payload if digest is None else digest)
+    record_context(agent, saved=estimate_tokens(json.dumps(payload, indent=2)) - estimate_tokens(text))
+    return text
+
+def shared_context(agent, ctx, kind):
+    ctx = ctx or workspace().context()
+    record_context(agent, saved=ctx["tokens_saved"][kind])
+    return ctx[kind]
+
+# Answer Retrieval
+ANSWER_THRESHOLD = float(os.environ.get("ANSWER_THRESHOLD", 0.8))
+GROUNDING_THRESHOLD = float(os.environ.get("GROUNDING_THRESHOLD", 0.45))
+GROUNDING_MATCHES = int(os.environ.get("GROUNDING_MATCHES", 3))
+NGRAM_SIZES = (3, 4, 5)
+retrieval_stats = {}
+
+def char_ngrams(text):
+    text = f" {norm(text)} "
+    grams = {}
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            gram = text[i:i + n]
+            grams[gram] = grams.get(gram, 0) + 1
+    return grams
+
+class AnswerIndex:
+    def __init__(self, entries):
+        pairs = [(entry, char_ngrams(entry["question"])) for entry in entries]
+        pairs = [(entry, grams) for entry, grams in pairs if grams]
+        self.entries = [entry for entry, _ in pairs]
+        docs = [grams for _, grams in pairs]
+        self.vocab = {}
+        for grams in docs:
+            for gram in grams:
+                self.vocab.setdefault(gram, len(self.vocab))
+        df = np.zeros(len(self.vocab))
+        for grams in docs:
+            df[[self.vocab[gram] for gram in grams]] += 1
+        self.idf = np.log((1 + len(docs)) / (1 + df)) + 1
+        self.unseen_idf = np.log(1 + len(docs)) + 1
+        postings = [[] for _ in self.vocab]
+        for d, grams in enumerate(docs):
+            ids = np.array([self.vocab[gram] for gram in grams], dtype=np.int64)
+            weights = (1 + np.log(np.fromiter(grams.values(), float))) * self.idf[ids]
+            weights /= np.linalg.norm(weights)
+            for t, w in zip(ids, weights):
+                postings[t].append((d, w))
+        self.indptr = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum([len(p) for p in postings])
+        self.docs = np.array([d for p in postings for d, _ in p], dtype=np.int64)
+        self.weights = np.array([w for p in postings for _, w in p])
+    
+    def search(self, text, k=GROUNDING_MATCHES):
+        grams = char_ngrams(text)
+        if not grams or not self.entries:
+            return []
+        ids = np.array([self.vocab.get(gram, -1) for gram in grams], dtype=np.int64)
+        known = ids >= 0
+        tf = 1 + np.log(np.fromiter(grams.values(), float))
+        query = tf * np.where(known, self.idf[np.maximum(ids, 0)], self.unseen_idf)
+        query /= np.linalg.norm(query)
+        ids, query = ids[known], query[known]
+        starts, lengths = self.indptr[ids], self.indptr[ids + 1] - self.indptr[ids]
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        scores = np.bincount(self.docs[offsets], weights=self.weights[offsets] * np.repeat(query, lengths), minlength=len(self.entries))
+        top = np.argsort(-scores)[:k]
+        return [(float(scores[i]), self.entries[i]) for i in top if scores[i] > 0]
+
+def answer_entries(data, kind):
+    faq = ((data.get("product") or {}).get("copy") or {}).get("faq") or []
+    entries = [{"question": item["q"], "answer": item["a"], "source": "faq"} for item in faq if item.get("q") and item.get("a")]
+    entries += [{"question": item["question"], "answer": item["answer"], "source": "approved"}
+                for item in data.get("answers", []) if item.get("kind", "inquiry") == kind]
+    return entries
+
+def retrieve(index, kind, message):
+    stats = retrieval_stats.setdefault(kind, {"lookups": 0, "answered": 0, "grounded": 0, "missed": 0, "seconds": 0.0})
+    start = time.perf_counter()
+    matches = index.search(message) if index and message else []
+    stats["lookups"] += 1
+    stats["seconds"] += time.perf_counter() - start
+    if matches and matches[0][0] >= ANSWER_THRESHOLD:
+        result = "answered"
+    elif matches and matches[0][0] >= GROUNDING_THRESHOLD:
+        result = "grounded"
+    else:
+        result = "missed"
+    stats[result] += 1
+    metrics.retrievals.inc(kind, result)
+    if result == "answered":
+        return matches[0], ""
+    grounding = [f"Q: {entry['question']}\nA: {entry['answer']}" for score, entry in matches if score >= GROUNDING_THRESHOLD]
+    return None, "Approved answers to similar questions:\n" + "\n\n".join(grounding) if grounding else ""
+
+def matched(match):
+    score, entry = match
+    return {"question": entry["question"], "source": entry["source"], "score": round(score, 3)}
+
+def local_reply(result):
+    yield "token", result["response"]
+    yield "done", result
+
+def retrieval_summary():
+    kinds = {}
+    for kind, stats in retrieval_stats.items():
+        kinds[kind] = {
+            **stats,
+            "hit_rate": round(stats["answered"] / stats["lookups"], 3) if stats["lookups"] else 0,
+            "grounded_rate": round(stats["grounded"] / stats["lookups"], 3) if stats["lookups"] else 0,
+            "avg_ms": round(stats["seconds"] * 1000 / stats["lookups"], 3) if stats["lookups"] else 0
+        }
+    return {
+        "answer_threshold": ANSWER_THRESHOLD,
+        "grounding_threshold": GROUNDING_THRESHOLD,
+        "grounding_matches": GROUNDING_MATCHES,
+        "kinds": kinds
+    }
+
+# Pipeline
+class Pipeline:
+    def __init__(self, concurrency=None, key=None):
+        self.concurrency = concurrency or int(os.environ.get("BUILD_CONCURRENCY", 6))
+        self.key = key
+        self.stages = {}
+        self.timings = {}
+        self.hashes = {}
+        self.reused = []
+    
+    def input_hash(self, name, inputs):
+        payload = json.dumps({"stage": name, "key": self.key, "inputs": inputs}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode()).hexdigest()[:16]
+    
+    def stage(self, name, fn, deps=()):
+        self.stages[name] = (fn, list(deps))
+    
+    def timed(self, name, fn, origin):
+        def run(**inputs):
+            gevent.getcurrent().origin = origin
+            start = time.monotonic()
+            try:
+                return fn(**inputs)
+            finally:
+                self.timings[name] = round(time.monotonic() - start, 3)
+                metrics.stage_seconds.observe(name, value=self.timings[name])
+        return run
+    
+    def run(self, on_stage=None, reuse=None):
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        reuse = reuse or {}
+        origin = current_origin()
+        pool = Pool(self.concurrency)
+        try:
+            while pending or running:
+                ready = True
+                while ready:
+                    ready = False
+                    for name, (fn, deps) in list(pending.items()):
+                        if not all(d in results for d in deps):
+                            continue
+                        del pending[name]
+                        inputs = {d: results[d] for d in deps}
+                        self.hashes[name] = self.input_hash(name, inputs)
+                        if name in reuse and reuse[name][0] == self.hashes[name]:
+                            results[name] = reuse[name][1]
+                            self.reused.append(name)
+                            if on_stage:
+                                on_stage(name, results[name], True)
+                            ready = True
+                        else:
+                            running[pool.spawn(self.timed(name, fn, origin), **inputs)] = name
+                if not running:
+                    if pending:
+                        raise ValueError(f"Unresolvable stages: {', '.join(pending)}")
+                    break
+                for job in gevent.wait(list(running), count=1):
+                    name = running.pop(job)
+                    results[name] = job.get()
+                    if on_stage:
+                        on_stage(name, results[name])
+        except BaseException:
+            pool.kill()
+            raise
+        return results
+
+# Sharded Generation
+SHARD_CONCURRENCY = int(os.environ.get("SHARD_CONCURRENCY", 4))
+SHARD_CONTINUATIONS = int(os.environ.get("SHARD_CONTINUATIONS", 2))
+SOCIAL_DAYS = 14
+SOCIAL_SHARD = int(os.environ.get("SOCIAL_SHARD", 4))
+EMAIL_COUNT = 5
+EMAIL_SHARD = int(os.environ.get("EMAIL_SHARD", 1))
+EMAIL_PLAN = "1 deliver the lead magnet, 2 build trust with a story, 3 teach a quick win, 4 handle objections, 5 make the offer"
+OUTREACH_TEMPLATES = int(os.environ.get("OUTREACH_TEMPLATES", 6))
+OUTREACH_TARGETS = int(os.environ.get("OUTREACH_TARGETS", 6))
+OUTREACH_SHARD = int(os.environ.get("OUTREACH_SHARD", 3))
+LEAD_SHARD = int(os.environ.get("LEAD_SHARD", 10))
+
+def gather(calls, concurrency=None):
+    origin = current_origin()
+    
+    def run(call):
+        gevent.getcurrent().origin = origin
+        return call()
+    
+    pool = Pool(concurrency or SHARD_CONCURRENCY)
+    try:
+        return pool.map(run, calls)
+    except BaseException:
+        pool.kill()
+        raise
+
+def norm(text):
+    return re.sub(r"\W+", " ", str(text or "")).strip().lower()
+
+def dedupe(items, key):
+    seen, unique = set(), []
+    for item in items:
+        k = key(item)
+        if k in seen:
+            continue
+        seen.add(k)
+        unique.append(item)
+    return unique
+
+def span(start, end, noun):
+    return f"{noun} {end}" if end - start == 1 else f"{noun}s {start + 1}-{end}"
+
+def generate_list(agent, field, task, total, size, cache=True, site=None, key=None):
+    def shard(start, end, depth=0):
+        result, stop_reason = agent.complete_json(task(start, end), cache=cache, site=site)
+        items = result.get(field) if isinstance(result, dict) else None
+        items = [item for item in items if isinstance(item, dict)][:end - start] if isinstance(items, list) else []
+        if stop_reason == "max_tokens":
+            items = items[:-1]
+        results = [{**result, field: items} if isinstance(result, dict) else {field: items}]
+        done = start + len(items)
+        if done >= end or depth >= SHARD_CONTINUATIONS:
+            return results
+        metrics.shard_continuations.inc(site or agent.name)
+        print(f"{agent.name}: {site} shard {start + 1}-{end} stopped at {done} ({stop_reason}), continuing")
+        if items or end - done == 1:
+            return results + shard(done, end, depth + 1)
+        middle = (done + end) // 2
+        return results + [r for part in gather([partial(shard, done, middle, depth + 1), partial(shard, middle, end, depth + 1)]) for r in part]
+    
+    bounds = [(start, min(start + size, total)) for start in range(0, total, max(1, size))]
+    results = [r for part in gather([partial(shard, start, end) for start, end in bounds]) for r in part]
+    items = [item for r in results for item in r[field]]
+    return (dedupe(items, key) if key else items), results
 
 # Core Functions
-def research_market(niche):
-    market = researcher.run_json(f"""Research market for: {niche}
+def research_niche(niche, cache=True):
+    return researcher.run_json(f"""Research market for: {niche}
 
 Return JSON:
 {{
@@ -89,18 +2200,20 @@ Return JSON:
     "pricing": {{"low": "$X", "mid": "$X", "high": "$X", "sweet_spot": "$X"}},
     "demand_signals": ["evidence"],
     "buyer_urgency": "why buy now"
-}}""")
-    
-    competitors = competitor_analyst.run_json(f"""Analyze competitors in: {niche}
+}}""", cache=cache, site="market")
+
+def analyze_competitors(niche, cache=True):
+    return competitor_analyst.run_json(f"""Analyze competitors in: {niche}
 
 Return JSON:
 {{
     "top_products": [{{"name": "product", "price": "$X", "strengths": [], "weaknesses": [], "sales_level": "high/medium/low"}}],
     "gaps": [{{"gap": "unmet need", "opportunity": "how to fill"}}],
     "differentiation": ["ways to stand out"]
-}}""")
-    
-    audience = audience_profiler.run_json(f"""Create buyer persona for: {niche}
+}}""", cache=cache, site="competitors")
+
+def profile_audience(niche, cache=True):
+    return audience_profiler.run_json(f"""Create buyer persona for: {niche}
 
 Return JSON:
 {{
@@ -115,13 +2228,18 @@ Return JSON:
         "hangouts": ["where online"],
         "language": ["phrases they use"]
     }}
-}}""")
-    
-    return {"market": market, "competitors": competitors, "audience": audience}
+}}""", cache=cache, site="audience")
 
-def create_product(niche, research):
-    product = product_creator.run_json(f"""Create product for: {niche}
-Research: {json.dumps(research, indent=2)}
+def research_market(niche, cache=True):
+    pipeline = Pipeline()
+    pipeline.stage("market", lambda: research_niche(niche, cache))
+    pipeline.stage("competitors", lambda: analyze_competitors(niche, cache))
+    pipeline.stage("audience", lambda: profile_audience(niche, cache))
+    return pipeline.run()
+
+def design_product(niche, research, cache=True):
+    return product_creator.run_json(f"""Create product for: {niche}
+Research: {embed(product_creator, research, research_digest(research))}
 
 Return JSON:
 {{
@@ -132,10 +2250,11 @@ Return JSON:
     "sections": [{{"title": "section", "contents": ["items"], "result": "outcome"}}],
     "bonuses": [{{"name": "bonus", "value": "$X", "description": "what"}}],
     "time_to_result": "how fast"
-}}""")
-    
-    copy = copywriter.run_json(f"""Write sales copy for: {json.dumps(product, indent=2)}
-Audience: {json.dumps(research.get('audience', {}), indent=2)}
+}}""", cache=cache, site="product")
+
+def write_copy(product, audience, cache=True):
+    return copywriter.run_json(f"""Write sales copy for: {embed(copywriter, product)}
+Audience: {embed(copywriter, audience, audience_digest(audience))}
 
 Return JSON:
 {{
@@ -149,10 +2268,11 @@ Return JSON:
     "faq": [{{"q": "question", "a": "answer"}}],
     "guarantee": "risk reversal",
     "cta": "call to action"
-}}""")
-    
-    pricing = researcher.run_json(f"""Set pricing for: {json.dumps(product, indent=2)}
-Competitors: {json.dumps(research.get('competitors', {}), indent=2)}
+}}""", cache=cache, site="copy")
+
+def set_pricing(product, competitors, cache=True):
+    return researcher.run_json(f"""Set pricing for: {embed(researcher, product)}
+Competitors: {embed(researcher, competitors, competitor_digest(competitors))}
 
 Return JSON:
 {{
@@ -160,12 +2280,10 @@ Return JSON:
     "launch_price": 27,
     "value_stack": [{{"item": "included", "value": "$X"}}],
     "total_value": "$XXX"
-}}""")
-    
-    return {"product": product, "copy": copy, "pricing": pricing}
+}}""", cache=cache, site="pricing")
 
-def create_marketing(product, research):
-    lead_magnet = lead_generator.run_json(f"""Create lead magnet for: {json.dumps(product.get('product', {}), indent=2)}
+def create_lead_magnet(product, cache=True):
+    return lead_generator.run_json(f"""Create lead magnet for: {embed(lead_generator, product)}
 
 Return JSON:
 {{
@@ -178,18 +2296,21 @@ Return JSON:
         "bullets": ["benefits"],
         "cta": "button text"
     }}
-}}""")
-    
-    emails = email_writer.run_json(f"""Write 5-email welcome sequence.
-Lead magnet: {json.dumps(lead_magnet, indent=2)}
-Product: {json.dumps(product.get('product', {}), indent=2)}
-Price: ${product.get('pricing', {}).get('launch_price', 27)}
+}}""", cache=cache, site="lead_magnet")
+
+def write_emails(lead_magnet, product, pricing, cache=True):
+    def task(start, end):
+        return f"""Write {span(start, end, "email")} of a {EMAIL_COUNT}-email welcome sequence.
+Sequence plan: {EMAIL_PLAN}
+Lead magnet: {embed(email_writer, lead_magnet)}
+Product: {embed(email_writer, product, product_summary(product))}
+Price: ${pricing.get('launch_price', 27)}
 
 Return JSON:
 {{
     "emails": [
         {{
-            "number": 1,
+            "number": {start + 1},
             "send": "immediately",
             "purpose": "deliver lead magnet",
             "subject": "subject line",
@@ -197,19 +2318,25 @@ Return JSON:
             "cta": "call to action"
         }}
     ]
-}}""")
-    
-    social = content_creator.run_json(f"""Create 14 days of social content.
-Product: {json.dumps(product.get('product', {}), indent=2)}
-Audience: {json.dumps(research.get('audience', {}), indent=2)}
+}}"""
+    emails, _ = generate_list(email_writer, "emails", task, EMAIL_COUNT, EMAIL_SHARD, cache=cache, site="emails", key=lambda e: norm(e.get("subject")))
+    return {"emails": emails}
 
+def create_social(product, audience, cache=True, avoid=()):
+    used = f"\nAlready posted, don't reuse these hooks: {compact(list(avoid)[-30:])}\n" if avoid else ""
+    
+    def task(start, end):
+        return f"""Create {span(start, end, "day")} of a {SOCIAL_DAYS}-day social content calendar.
+Product: {embed(content_creator, product, product_summary(product))}
+Audience: {embed(content_creator, audience, audience_digest(audience))}
+{used}
 Mix: 60% value, 20% story/engagement, 20% promo
 
 Return JSON:
 {{
     "posts": [
         {{
-            "day": 1,
+            "day": {start + 1},
             "platform": "twitter",
             "type": "value",
             "hook": "first line",
@@ -218,13 +2345,16 @@ Return JSON:
             "hashtags": ["tags"]
         }}
     ]
-}}""")
-    
-    return {"lead_magnet": lead_magnet, "emails": emails, "social": social}
+}}"""
+    posts, _ = generate_list(content_creator, "posts", task, SOCIAL_DAYS, SOCIAL_SHARD, cache=cache, site="social", key=lambda p: norm(p.get("hook") or p.get("body")))
+    return {"posts": posts}
 
-def create_outreach(niche, research):
-    return outreach_agent.run_json(f"""Create outreach plan for: {niche}
-Target: {json.dumps(research.get('audience', {}), indent=2)}
+def create_outreach(niche, research, cache=True):
+    target = embed(outreach_agent, research.get('audience', {}), audience_digest(research.get('audience', {})))
+    
+    def plan():
+        return outreach_agent.run_json(f"""Create outreach plan for: {niche}
+Target: {target}
 
 Return JSON:
 {{
@@ -243,14 +2373,30 @@ Return JSON:
             "value_post": "example post",
             "soft_pitch": "how to mention product"
         }}
-    ],
+    ]
+}}""", cache=cache, site="outreach_plan")
+    
+    def dm_task(start, end):
+        return f"""Write {end - start} DM templates (#{start + 1}-{end}) for outreach in: {niche}
+Target: {target}
+
+Return JSON:
+{{
     "dm_templates": [
         {{
             "context": "when to use",
             "message": "template",
             "follow_up": "if no response"
         }}
-    ],
+    ]
+}}"""
+    
+    def cold_task(start, end):
+        return f"""Plan {end - start} cold outreach targets (#{start + 1}-{end}) for: {niche}
+Target: {target}
+
+Return JSON:
+{{
     "cold_outreach": [
         {{
             "target": "who to reach",
@@ -259,11 +2405,22 @@ Return JSON:
             "value_offer": "free thing to give"
         }}
     ]
-}}""")
-
-def find_leads(niche, count=10):
-    return outreach_agent.run_json(f"""Find {count} specific leads for: {niche}
-
+}}"""
+    
+    result, (dm_templates, _), (cold_outreach, _) = gather([
+        plan,
+        partial(generate_list, outreach_agent, "dm_templates", dm_task, OUTREACH_TEMPLATES, OUTREACH_SHARD, cache=cache, site="dm_templates", key=lambda t: norm(t.get("message"))),
+        partial(generate_list, outreach_agent, "cold_outreach", cold_task, OUTREACH_TARGETS, OUTREACH_SHARD, cache=cache, site="cold_outreach", key=lambda t: norm(t.get("target")))
+    ])
+    return {**result, "dm_templates": dm_templates, "cold_outreach": cold_outreach}
+
+def find_leads(niche, count=10, cache=True):
+    shards = -(-count // LEAD_SHARD)
+    
+    def task(start, end):
+        batch = f"\nBatch {start // LEAD_SHARD + 1} of {shards}: find different people than the other batches.\n" if shards > 1 else ""
+        return f"""Find {end - start} specific leads for: {niche}
+{batch}
 Look for people who:
 - Are discussing this problem
 - Asked for help recently
@@ -288,11 +2445,89 @@ Return JSON:
             "why": "what this finds"
         }}
     ]
-}}""")
+}}"""
+    leads, results = generate_list(outreach_agent, "leads", task, count, LEAD_SHARD, cache=cache, site="find_leads", key=lambda l: (norm(l.get("type")), norm(l.get("identifier"))))
+    queries = dedupe([q for r in results for q in r.get("search_queries", []) if isinstance(q, dict)], lambda q: norm(q.get("query")))
+    return {"leads": leads, "search_queries": queries}
+
+def build_pipeline(niche, concurrency=None, cache=True, fresh=()):
+    def cached(name):
+        return cache and name not in fresh
+    
+    pipeline = Pipeline(concurrency, key=niche)
+    pipeline.stage("market", lambda: research_niche(niche, cached("market")))
+    pipeline.stage("competitors", lambda: analyze_competitors(niche, cached("competitors")))
+    pipeline.stage("audience", lambda: profile_audience(niche, cached("audience")))
+    pipeline.stage("product", lambda market, competitors, audience: design_product(niche, {"market": market, "competitors": competitors, "audience": audience}, cached("product")), ["market", "competitors", "audience"])
+    pipeline.stage("copy", partial(write_copy, cache=cached("copy")), ["product", "audience"])
+    pipeline.stage("pricing", partial(set_pricing, cache=cached("pricing")), ["product", "competitors"])
+    pipeline.stage("lead_magnet", partial(create_lead_magnet, cache=cached("lead_magnet")), ["product"])
+    pipeline.stage("emails", partial(write_emails, cache=cached("emails")), ["lead_magnet", "product", "pricing"])
+    pipeline.stage("social", partial(create_social, cache=cached("social")), ["product", "audience"])
+    pipeline.stage("outreach_plan", lambda audience: create_outreach(niche, {"audience": audience}, cached("outreach_plan")), ["audience"])
+    pipeline.stage("initial_leads", lambda: find_leads(niche, 10, cached("initial_leads")))
+    return pipeline
+
+BUILD_STAGES = list(build_pipeline("").stages)
+
+STAGE_OUTPUTS = {
+    "market": ("research", "market"),
+    "competitors": ("research", "competitors"),
+    "audience": ("research", "audience"),
+    "product": ("product", "product"),
+    "copy": ("product", "copy"),
+    "pricing": ("product", "pricing"),
+    "lead_magnet": ("marketing", "lead_magnet"),
+    "emails": ("marketing", "emails"),
+    "social": ("marketing", "social"),
+    "outreach_plan": ("outreach_plan", None),
+    "initial_leads": ("initial_leads", None)
+}
 
-def process_lead(lead_data, product):
-    return lead_qualifier.run_json(f"""Qualify this lead: {json.dumps(lead_data, indent=2)}
-Product: {json.dumps(product, indent=2)}
+def stage_outputs(results):
+    sections = {}
+    for name, (section, key) in STAGE_OUTPUTS.items():
+        if key:
+            sections.setdefault(section, {})[key] = results[name]
+        else:
+            sections[section] = results[name]
+    return sections
+
+def stored_results(data):
+    results = {}
+    for name, (section, key) in STAGE_OUTPUTS.items():
+        value = data.get(section)
+        if key:
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is not None:
+            results[name] = value
+    return results
+
+def apply_edit(results, path, value):
+    stage, *fields = path.split(".")
+    if not fields:
+        results[stage] = value
+        return
+    target = results.setdefault(stage, {})
+    for field in fields[:-1]:
+        if not isinstance(target.get(field), dict):
+            target[field] = {}
+        target = target[field]
+    target[fields[-1]] = value
+
+def reusable_stages(data, niche, fresh=(), edits=None):
+    stored = stored_results(data)
+    hashes = data.get("config", {}).get("stage_hashes")
+    if not hashes:
+        pipeline = build_pipeline(niche)
+        hashes = {name: pipeline.input_hash(name, {d: stored.get(d) for d in deps}) for name, (_, deps) in pipeline.stages.items()}
+    results = json.loads(json.dumps(stored))
+    for path, value in (edits or {}).items():
+        apply_edit(results, path, value)
+    return {name: (hashes[name], result) for name, result in results.items() if name not in fresh and name in hashes}
+
+def process_lead(lead_data, ctx, cache=True):
+    return lead_qualifier.run_json(f"""Qualify this lead: {embed(lead_qualifier, lead_data)}
 
 Return JSON:
 {{
@@ -301,11 +2536,10 @@ Return JSON:
     "response": "personalized message to send",
     "follow_up": [{{"when": "timing", "action": "what to do"}}],
     "notes": "observations"
-}}""")
+}}""", cache=cache, shared=shared_context(lead_qualifier, ctx, "product"), site="qualify")
 
-def handle_inquiry(message, product):
-    return sales_closer.run_json(f"""Handle this sales inquiry: "{message}"
-Product: {json.dumps(product, indent=2)}
+def inquiry_task(message):
+    return f"""Handle this sales inquiry: "{message}"
 
 Return JSON:
 {{
@@ -314,11 +2548,33 @@ Return JSON:
     "objections": ["detected concerns"],
     "next_action": "what to do next",
     "close_ready": false
-}}""")
+}}"""
+
+def inquiry_reply(match):
+    return {
+        "intent": "question",
+        "response": match[1]["answer"],
+        "objections": [],
+        "next_action": "answer the follow-up if they reply",
+        "close_ready": False,
+        "matched": matched(match)
+    }
+
+def handle_inquiry(message, ctx, cache=True, answers=None):
+    match, grounding = retrieve(answers, "inquiry", message)
+    if match:
+        return inquiry_reply(match)
+    return sales_closer.run_json(inquiry_task(message), grounding, cache=cache, shared=shared_context(sales_closer, ctx, "sales"), site="inquiry")
+
+def stream_inquiry(message, ctx, cache=True, answers=None):
+    match, grounding = retrieve(answers, "inquiry", message)
+    if match:
+        return local_reply(inquiry_reply(match))
+    return sales_closer.stream_json(inquiry_task(message), grounding, cache=cache, shared=shared_context(sales_closer, ctx, "sales"), site="inquiry")
 
-def handle_support(message, customer=None):
-    return support_agent.run_json(f"""Handle support request: "{message}"
-Customer: {json.dumps(customer or {}, indent=2)}
+def support_task(message, customer=None):
+    return f"""Handle support request: "{message}"
+Customer: {embed(support_agent, customer or {})}
 
 Return JSON:
 {{
@@ -326,351 +2582,1166 @@ Return JSON:
     "response": "helpful reply",
     "resolution": "how this resolves it",
     "follow_up": false
-}}""")
+}}"""
+
+def support_reply(match):
+    return {
+        "category": "question",
+        "response": match[1]["answer"],
+        "resolution": f"Answered from {'the FAQ' if match[1]['source'] == 'faq' else 'an approved reply'}",
+        "follow_up": False,
+        "matched": matched(match)
+    }
+
+def handle_support(message, customer=None, ctx=None, cache=True, answers=None):
+    match, grounding = retrieve(answers, "support", message)
+    if match:
+        return support_reply(match)
+    return support_agent.run_json(support_task(message, customer), grounding, cache=cache, shared=shared_context(support_agent, ctx, "sales"), site="support")
+
+def stream_support(message, customer=None, ctx=None, cache=True, answers=None):
+    match, grounding = retrieve(answers, "support", message)
+    if match:
+        return local_reply(support_reply(match))
+    return support_agent.stream_json(support_task(message, customer), grounding, cache=cache, shared=shared_context(support_agent, ctx, "sales"), site="support")
+
+LEAD_CONCURRENCY = int(os.environ.get("LEAD_CONCURRENCY", 8))
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 1000))
+STREAM_CHUNK = 64 * 1024
+JSON_ENCODER = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+# Lead Scoring
+LEAD_ESCALATE = float(os.environ.get("LEAD_ESCALATE", 5))
+LEAD_ESCALATIONS = int(os.environ.get("LEAD_ESCALATIONS", 50))
+LEAD_HALF_LIFE_DAYS = float(os.environ.get("LEAD_HALF_LIFE_DAYS", 7))
+LEAD_FEATURES = ("overlap", "urgency", "platform", "recency")
+LEAD_WEIGHTS = {"overlap": 0.4, "urgency": 0.35, "platform": 0.1, "recency": 0.15, **json.loads(os.environ.get("LEAD_WEIGHTS") or "{}")}
+KEYWORD_TARGET = 3
+URGENCY_SCORES = {"hot": 1.0, "warm": 0.5, "cold": 0.0}
+STOPWORDS = frozenset("""about after again also been being could does doing down even from have just like more most much need only over really same should some such than that their them then there these they this those very want what when where which while will with would your""".split())
+
+def keywords(text):
+    return {word for word in norm(text).split() if len(word) > 3 and word not in STOPWORDS}
+
+def timestamp(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return np.nan
+
+class LeadScorer:
+    def __init__(self, research):
+        persona = ((research or {}).get("audience") or {}).get("persona") or {}
+        phrases = [*map(str, persona.get("language") or []), str(persona.get("biggest_problem") or "")]
+        self.vocab = keywords(" ".join(phrases))
+        self.hangouts = norm(" ".join(map(str, persona.get("hangouts") or [])))
+        self.weights = np.array([LEAD_WEIGHTS.get(name, 0) for name in LEAD_FEATURES], dtype=float)
+        self.weights /= self.weights.sum() or 1
+    
+    def features(self, leads, now=None):
+        hits = np.array([len(self.vocab & keywords(f"{lead.get('signal', '')} {lead.get('pain_point', '')} {lead.get('identifier', '')}")) for lead in leads], dtype=float)
+        urgency = np.array([URGENCY_SCORES.get(norm(lead.get("urgency")), 0.25) for lead in leads])
+        platforms = [norm(lead.get("type")) for lead in leads]
+        platform = np.array([1.0 if p and p in self.hangouts else 0.5 if p else 0.0 for p in platforms])
+        age_days = ((now or time.time()) - np.array([timestamp(lead.get("found")) for lead in leads])) / 86400
+        recency = np.where(np.isnan(age_days), 0.5, 0.5 ** (np.maximum(age_days, 0) / LEAD_HALF_LIFE_DAYS))
+        overlap = np.minimum(hits / max(min(KEYWORD_TARGET, len(self.vocab)), 1), 1)
+        return np.column_stack([overlap, urgency, platform, recency])
+    
+    def score(self, leads, now=None):
+        if not leads:
+            return []
+        scores = self.features(leads, now) @ self.weights * 10
+        return [{**lead, "prescore": round(float(s), 2)} for lead, s in zip(leads, scores)]
+
+def escalation_queue(leads):
+    heap = [(-lead["prescore"], i, lead) for i, lead in enumerate(leads) if lead["prescore"] >= LEAD_ESCALATE]
+    heapq.heapify(heap)
+    return heap
+
+def drain(heap, limit):
+    for _ in range(min(limit, len(heap))):
+        yield heapq.heappop(heap)[2]
+
+def local_qualification(lead):
+    return {
+        "score": lead["prescore"],
+        "intent": "warm" if lead["prescore"] >= LEAD_ESCALATE / 2 else "cold",
+        "response": lead.get("approach", ""),
+        "follow_up": [],
+        "notes": f"Pre-scored {lead['prescore']} locally, below escalation threshold {LEAD_ESCALATE:g}",
+        "qualified_by": "prescore"
+    }
+
+# Build Jobs
+MAX_JOBS = int(os.environ.get("MAX_JOBS", 50))
+JOB_DIR = os.environ.get("JOB_DIR", "jobs")
+JOB_POLL = float(os.environ.get("JOB_POLL", 0.5))
+JOB_ID = re.compile(r"[0-9a-f]{12}")
+jobs = OrderedDict()
+
+class Job:
+    def __init__(self, niche, workspace=DEFAULT_WORKSPACE, kind="build", id=None):
+        self.id = id or uuid.uuid4().hex[:12]
+        self.niche = niche
+        self.workspace = workspace
+        self.kind = kind
+        self.status = "queued"
+        self.created = datetime.now().isoformat()
+        self.finished_at = None
+        self.stages = {}
+        self.reused = []
+        self.events = []
+        self.result = None
+        self.error = None
+        self.greenlet = None
+        self.timings = {}
+        self.changed = threading.Condition()
+        self.log = None
+    
+    @classmethod
+    def load(cls, job_id):
+        if not JOB_ID.fullmatch(job_id or ""):
+            return None
+        try:
+            with open(os.path.join(JOB_DIR, f"{job_id}.jsonl"), "rb") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return None
+        job = None
+        for line in lines:
+            if not line.endswith(b"\n"):
+                break
+            event, payload = json.loads(line)
+            if event == "created":
+                job = cls(payload["niche"], payload["workspace"], payload["kind"], id=job_id)
+                job.created = payload["created"]
+            elif event == "final":
+                job.finished_at, job.timings, job.result, job.error = payload["finished"], payload["timings"], payload["result"], payload["error"]
+            elif job is not None:
+                job.replay(event, payload)
+        return job
+    
+    def path(self, suffix=".jsonl"):
+        return os.path.join(JOB_DIR, self.id + suffix)
+    
+    def open(self):
+        os.makedirs(JOB_DIR, exist_ok=True)
+        self.log = open(self.path(), "a")
+        self.write("created", {"niche": self.niche, "workspace": self.workspace, "kind": self.kind, "created": self.created})
+    
+    def write(self, event, payload):
+        if self.log:
+            self.log.write(compact([event, payload]) + "\n")
+            self.log.flush()
+    
+    def start(self, ws, *args):
+        self.greenlet = gevent.spawn(run_build, self, ws, *args)
+        self.greenlet.origin = self.kind
+        gevent.spawn(self.watch)
+    
+    def watch(self):
+        while not self.finished:
+            if os.path.exists(self.path(".cancel")):
+                self.greenlet.kill(block=False)
+                return
+            gevent.sleep(JOB_POLL * 2)
+    
+    def cancel(self):
+        if self.greenlet:
+            self.greenlet.kill()
+        elif not self.finished:
+            open(self.path(".cancel"), "a").close()
+    
+    @property
+    def finished(self):
+        return self.status in ("complete", "failed", "cancelled")
+    
+    def replay(self, event, payload):
+        if event == "stage":
+            self.stages[payload["stage"]] = payload["result"]
+            if payload["reused"]:
+                self.reused.append(payload["stage"])
+        else:
+            self.status = event
+        self.events.append((event, payload))
+    
+    def emit(self, event, payload):
+        with self.changed:
+            self.events.append((event, payload))
+            self.changed.notify_all()
+        self.write(event, payload)
+    
+    def set_status(self, status, **payload):
+        self.status = status
+        if self.finished:
+            self.finished_at = datetime.now().isoformat()
+        self.emit(status, {"job_id": self.id, "status": status, **payload})
+        if self.finished and self.log:
+            self.write("final", {"finished": self.finished_at, "timings": self.timings, "result": self.result, "error": self.error})
+            self.log.close()
+            self.log = None
+            if os.path.exists(self.path(".cancel")):
+                os.remove(self.path(".cancel"))
+    
+    def stage_done(self, name, result, reused=False):
+        self.stages[name] = result
+        if reused:
+            self.reused.append(name)
+        print(f"[{self.id}] {name} {'reused' if reused else 'done'}")
+        self.emit("stage", {
+            "stage": name,
+            "progress": f"{len(self.stages)}/{len(BUILD_STAGES)}",
+            "reused": reused,
+            "result": result
+        })
+    
+    def summary(self):
+        return {
+            "job_id": self.id,
+            "niche": self.niche,
+            "workspace": self.workspace,
+            "kind": self.kind,
+            "status": self.status,
+            "created": self.created,
+            "finished": self.finished_at,
+            "completed_stages": list(self.stages),
+            "reused_stages": self.reused,
+            "total_stages": len(BUILD_STAGES)
+        }
+    
+    def to_dict(self):
+        return {**self.summary(), "stages": self.stages, "timings": self.timings, "result": self.result, "error": self.error}
+
+def add_job(job):
+    job.open()
+    jobs[job.id] = job
+    for old_id in [i for i, j in jobs.items() if j.finished][:max(0, len(jobs) - MAX_JOBS)]:
+        del jobs[old_id]
+    names = sorted(job_files(), key=lambda name: os.path.getmtime(os.path.join(JOB_DIR, name)))
+    for name in names[:max(0, len(names) - MAX_JOBS)]:
+        old = jobs.get(name[:-6])
+        if old is None or old.finished:
+            for suffix in (".jsonl", ".cancel"):
+                if os.path.exists(os.path.join(JOB_DIR, name[:-6] + suffix)):
+                    os.remove(os.path.join(JOB_DIR, name[:-6] + suffix))
+
+def job_files():
+    return [name for name in os.listdir(JOB_DIR) if name.endswith(".jsonl")] if os.path.isdir(JOB_DIR) else []
+
+def find_job(job_id):
+    return jobs.get(job_id) or Job.load(job_id)
+
+def run_build(job, ws, concurrency=None, cache=True, fresh=(), edits=None):
+    try:
+        build_workspace(job, ws, concurrency, cache, fresh, edits)
+    finally:
+        workspaces.release(ws)
+
+def build_workspace(job, ws, concurrency=None, cache=True, fresh=(), edits=None):
+    niche = job.niche
+    rebuild = job.kind == "rebuild"
+    print(f"{'Rebuilding' if rebuild else 'Building'}: {niche} ({ws.id})")
+    job.set_status("running")
+    try:
+        start = time.monotonic()
+        pipeline = build_pipeline(niche, concurrency, cache, fresh)
+        reuse = reusable_stages(ws.data, niche, fresh, edits) if rebuild else None
+        results = pipeline.run(on_stage=job.stage_done, reuse=reuse)
+        job.timings = pipeline.timings
+        
+        sections = stage_outputs(results)
+        values = {k: v for k, v in sections.items() if not rebuild or v != ws.data.get(k)}
+        if not rebuild or "research" in values or "product" in values:
+            values["context"] = build_context(sections["research"], sections["product"])
+        now = datetime.now().isoformat()
+        values["config"] = {
+            "niche": niche,
+            "created": ws.data.get("config", {}).get("created", now) if rebuild else now,
+            "updated": now,
+            "build_seconds": round(time.monotonic() - start, 3),
+            "stage_timings": pipeline.timings,
+            "stage_hashes": pipeline.hashes,
+            "reused_stages": pipeline.reused
+        }
+        ws.store.record("set", sync=True, values=values)
+    except gevent.GreenletExit:
+        print(f"[{job.id}] Build cancelled")
+        job.set_status("cancelled")
+        raise
+    except Exception as e:
+        print(f"[{job.id}] Build failed: {e}")
+        job.error = str(e)
+        job.set_status("failed", error=job.error)
+        return
+    
+    print("Done!")
+    job.result = {
+        "workspace": ws.id,
+        "product": ws.data["product"].get("product", {}).get("name"),
+        "price": ws.data["product"].get("pricing", {}).get("launch_price"),
+        "leads_found": len(ws.data.get("initial_leads", {}).get("leads", [])),
+        "next_steps": [
+            "GET /payhip-copy - Copy to your store",
+            "GET /find-leads - Contact these people",
+            "GET /daily-post - Post this today",
+            "GET /outreach-plan - Follow this daily"
+        ]
+    }
+    job.set_status("complete", result=job.result)
+
+def encode_cursor(offsets):
+    return base64.urlsafe_b64encode(compact(offsets).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    if not cursor:
+        return {}
+    try:
+        offsets = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return {k: int(v) for k, v in offsets.items()}
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError("Invalid cursor")
+
+def page_args():
+    limit = min(int(request.args.get("limit", PAGE_SIZE)), MAX_PAGE_SIZE)
+    fields = [f for f in request.args.get("fields", "").split(",") if f]
+    return decode_cursor(request.args.get("cursor")), max(limit, 1), fields
+
+def paginate(items, offset, limit, fields):
+    chunk = items[offset:offset + limit]
+    if fields:
+        chunk = [{f: item.get(f) for f in fields} if isinstance(item, dict) else item for item in chunk]
+    return chunk, (offset + limit if offset + limit < len(items) else None)
+
+def paged_response(lists, fields, limit, offsets, **extra):
+    body, next_offsets = dict(extra), {}
+    for name, items in lists.items():
+        body[name], next_offset = paginate(items, offsets.get(name, 0), limit, fields)
+        if next_offset is not None:
+            next_offsets[name] = next_offset
+    body["next_cursor"] = encode_cursor({**offsets, **next_offsets}) if next_offsets else None
+    return json_response(body)
+
+def accepted_encoding():
+    accepted = request.headers.get("Accept-Encoding", "")
+    if brotli and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+def encode_json(obj):
+    buffer, size = [], 0
+    for chunk in JSON_ENCODER.iterencode(obj):
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+def compress(chunks, encoding):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        for chunk in chunks:
+            out = compressor.process(chunk)
+            if out:
+                yield out
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            out = compressor.compress(chunk)
+            if out:
+                yield out
+        yield compressor.flush()
+
+def json_response(obj=None, chunks=None):
+    ws = workspace()
+    etag = f'W/"{ws.id}-{ws.store.seq}-{hashlib.sha1(request.full_path.encode()).hexdigest()[:12]}"'
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers=headers)
+    chunks = encode_json(obj) if chunks is None else chunks
+    encoding = accepted_encoding()
+    if encoding:
+        chunks = compress(chunks, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(stream_with_context(chunks), mimetype="application/json", headers=headers)
+
+def sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def event_stream(events):
+    return Response(stream_with_context(events), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+# Background Scheduler
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER", "1") != "0"
+SCHEDULER_TICK = float(os.environ.get("SCHEDULER_TICK", 60))
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", 2))
+SCHEDULER_JITTER = float(os.environ.get("SCHEDULER_JITTER", 0.1))
+SCHEDULER_LEASE = float(os.environ.get("SCHEDULER_LEASE", 1800))
+OFF_PEAK_HOURS = os.environ.get("OFF_PEAK_HOURS", "1-6")
+SOCIAL_REFRESH_DAYS = int(os.environ.get("SOCIAL_REFRESH_DAYS", 3))
+DEFAULT_SCHEDULES = {
+    "find_leads": {"enabled": True, "every": 6 * 3600, "count": 20},
+    "refresh_social": {"enabled": True, "every": 3600, "days_ahead": SOCIAL_REFRESH_DAYS},
+    "requalify": {"enabled": True, "every": 24 * 3600, "off_peak": True, "stale_days": 14, "limit": LEAD_ESCALATIONS}
+}
+SCHEDULE_OVERRIDES = json.loads(os.environ.get("SCHEDULES") or "{}")
+
+def off_peak(now):
+    start, end = (int(hour) for hour in OFF_PEAK_HOURS.split("-"))
+    return start <= now.hour < end if start <= end else now.hour >= start or now.hour < end
+
+def schedule_config(data, task):
+    return {**DEFAULT_SCHEDULES[task], **SCHEDULE_OVERRIDES.get(task, {}), **data.get("schedules", {}).get(task, {}).get("config", {})}
+
+def jittered(now, seconds):
+    return (now + timedelta(seconds=seconds * random.uniform(1 - SCHEDULER_JITTER, 1 + SCHEDULER_JITTER))).isoformat()
+
+def task_due(state, config, built, now):
+    if not config["enabled"] or not built or not state.get("next_run"):
+        return False
+    if state.get("lease") and datetime.fromisoformat(state["lease"]) > now:
+        return False
+    if config.get("off_peak") and not off_peak(now) and not state.get("forced"):
+        return False
+    return datetime.fromisoformat(state["next_run"]) <= now
+
+def due(data, task, now):
+    return task_due(data.get("schedules", {}).get(task, {}), schedule_config(data, task), bool(data.get("config", {}).get("niche")), now)
+
+def unscheduled(data, task):
+    return bool(data.get("config", {}).get("niche")) and "next_run" not in data.get("schedules", {}).get(task, {})
+
+def schedule_index_path(snapshot_path):
+    return os.path.splitext(snapshot_path)[0] + "-schedules.json"
+
+def schedule_index(data):
+    tasks = {}
+    for task in SCHEDULE_TASKS:
+        config, state = schedule_config(data, task), data.get("schedules", {}).get(task, {})
+        tasks[task] = {"enabled": config["enabled"], "off_peak": bool(config.get("off_peak")), **{k: state.get(k) for k in ("next_run", "lease", "forced")}}
+    return {"built": bool(data.get("config", {}).get("niche")), "tasks": tasks}
+
+def write_schedule_index(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(compact(schedule_index(data)))
+    os.replace(tmp, path)
+
+def read_schedule_index(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def parse_date(value):
+    try:
+        return datetime.fromisoformat(str(value).split(".")[0])
+    except ValueError:
+        return datetime.now()
+
+def social_calendar(data):
+    social = data.get("marketing", {}).get("social", {})
+    start = parse_date(social.get("start") or data.get("config", {}).get("created", datetime.now().isoformat()))
+    return social.get("posts", []), (datetime.now() - start).days
+
+def scheduled_find_leads(ws, config):
+    leads = find_leads(ws.data["config"]["niche"], int(config["count"]), cache=False)
+    ws.store.record("outreach", entry={"time": datetime.now().isoformat(), "leads": leads, "scheduled": True})
+    return {"leads": len(leads["leads"])}
+
+def scheduled_refresh_social(ws, config):
+    posts, day = social_calendar(ws.data)
+    remaining = len(posts) - day
+    if not posts or remaining > int(config["days_ahead"]):
+        return {"remaining_days": remaining}
+    kept = posts[day:] if day < len(posts) else []
+    fresh = create_social(ws.data.get("product", {}).get("product", {}), ws.data.get("research", {}).get("audience", {}),
+                          cache=False, avoid=[p.get("hook") for p in posts if p.get("hook")])
+    social = {"posts": [{**post, "day": i + 1} for i, post in enumerate(kept + fresh["posts"])], "start": datetime.now().date().isoformat()}
+    ws.store.record("set", values={"marketing": {**ws.data.get("marketing", {}), "social": social}})
+    return {"remaining_days": remaining, "added": len(fresh["posts"])}
+
+def scheduled_requalify(ws, config):
+    cutoff = (datetime.now() - timedelta(days=float(config["stale_days"]))).isoformat()
+    stale = [lead for lead in ws.store.leads.query(processed=True)[0] if str(lead.get("processed")) < cutoff][:int(config["limit"])]
+    if not stale:
+        return {"stale": 0}
+    scorer = ws.lead_scorer()
+    stale = scorer.score(stale) if scorer else [{**lead, "prescore": LEAD_ESCALATE} for lead in stale]
+    ctx = ws.context()
+    
+    def qualify(lead):
+        if lead["prescore"] < LEAD_ESCALATE:
+            return lead_record(lead, local_qualification(lead))
+        try:
+            return lead_record(lead, process_lead(lead, ctx, cache=False))
+        except Exception as e:
+            print(f"Requalify failed for {lead.get('identifier')}: {e}")
+            return None
+    
+    records = [r for r in gather([partial(qualify, lead) for lead in stale], LEAD_CONCURRENCY) if r]
+    if records:
+        ws.store.record("requalified", leads=records)
+    return {"stale": len(stale), "requalified": len(records), "escalated": sum(lead["prescore"] >= LEAD_ESCALATE for lead in stale)}
+
+SCHEDULE_TASKS = {
+    "find_leads": scheduled_find_leads,
+    "refresh_social": scheduled_refresh_social,
+    "requalify": scheduled_requalify
+}
+
+class BackgroundScheduler:
+    def __init__(self, concurrency=None, tick=None):
+        self.pool = Pool(concurrency or SCHEDULER_CONCURRENCY)
+        self.tick = tick or SCHEDULER_TICK
+        self.greenlet = None
+        self.running = set()
+        self.ticks = 0
+        self.runs = 0
+        self.failures = 0
+        self.deferred = 0
+    
+    def start(self):
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self.loop)
+            self.greenlet.origin = "scheduler"
+    
+    def stop(self):
+        if self.greenlet:
+            self.greenlet.kill(block=False)
+            self.greenlet = None
+        self.pool.kill(block=False)
+    
+    def loop(self):
+        gevent.sleep(self.tick * random.random())
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Scheduler tick failed: {e}")
+            gevent.sleep(self.tick * random.uniform(1 - SCHEDULER_JITTER, 1 + SCHEDULER_JITTER))
+    
+    def check(self):
+        self.ticks += 1
+        for id in workspaces.ids():
+            index = read_schedule_index(schedule_index_path(workspaces.paths(id)[0]))
+            if not index or not index["built"]:
+                continue
+            now = datetime.now()
+            tasks = [task for task, entry in index["tasks"].items() if task in SCHEDULE_TASKS and (id, task) not in self.running
+                     and (task_due(entry, entry, True, now) or entry["enabled"] and not entry["next_run"])]
+            if not tasks:
+                continue
+            with workspaces.use(id) as ws:
+                for task in tasks:
+                    if unscheduled(ws.data, task):
+                        ws.store.record("schedule", check=partial(unscheduled, task=task),
+                                        task=task, values={"next_run": jittered(datetime.now(), schedule_config(ws.data, task)["every"])})
+                        continue
+                    if not due(ws.data, task, datetime.now()):
+                        continue
+                    if self.pool.full():
+                        self.deferred += 1
+                        return
+                    now = datetime.now()
+                    if ws.store.record("schedule", check=partial(due, task=task, now=now), task=task,
+                                       values={"lease": (now + timedelta(seconds=SCHEDULER_LEASE)).isoformat(), "owner": os.getpid()}):
+                        self.running.add((id, task))
+                        self.pool.spawn(self.run, id, task).origin = f"schedule:{task}"
+    
+    def run(self, id, task):
+        start = time.monotonic()
+        try:
+            with workspaces.use(id) as ws:
+                state = ws.data.get("schedules", {}).get(task, {})
+                config = schedule_config(ws.data, task)
+                values = {"lease": None, "forced": False, "last_run": datetime.now().isoformat()}
+                try:
+                    values["last_result"] = SCHEDULE_TASKS[task](ws, config)
+                    values.update(runs=state.get("runs", 0) + 1, last_error=None, next_run=jittered(datetime.now(), config["every"]))
+                    self.runs += 1
+                except Exception as e:
+                    print(f"Scheduled {task} failed for {id}: {e}")
+                    values.update(failures=state.get("failures", 0) + 1, last_error=str(e), next_run=jittered(datetime.now(), config["every"] / 4))
+                    self.failures += 1
+                values["seconds"] = round(time.monotonic() - start, 3)
+                ws.store.record("schedule", task=task, values=values)
+        finally:
+            self.running.discard((id, task))
+    
+    def stats(self):
+        return {
+            "enabled": SCHEDULER_ENABLED and self.greenlet is not None,
+            "tick_seconds": self.tick,
+            "concurrency": self.pool.size,
+            "jitter": SCHEDULER_JITTER,
+            "off_peak_hours": OFF_PEAK_HOURS,
+            "off_peak_now": off_peak(datetime.now()),
+            "running": [f"{id}:{task}" for id, task in sorted(self.running)],
+            "ticks": self.ticks,
+            "runs": self.runs,
+            "failures": self.failures,
+            "deferred": self.deferred
+        }
+
+background = BackgroundScheduler()
 
 # API Endpoints
 @app.route("/")
 def home():
     return jsonify({
         "status": "running",
+        "workspaces": "Prefix any endpoint with /w/<workspace>, or pass ?workspace= or X-Workspace (default: \"default\")",
         "endpoints": {
-            "POST /build": "Build complete business",
+            "POST /build": "Start a build job (body: niche, workspace)",
+            "POST /rebuild": "Regenerate only affected stages (body: stages, edits like {\"pricing.launch_price\": 19})",
+            "GET /workspaces": "Workspaces on disk and in memory",
+            "GET /schedules": "Background find-leads, social refresh and requalify schedules (POST {tasks, run} to change)",
+            "GET /jobs/<id>": "Build job status and partial results (DELETE to cancel)",
+            "GET /jobs/<id>/events": "Build progress (server-sent events)",
             "GET /payhip-copy": "Get product description",
             "GET /email-sequence": "Get email sequence",
             "GET /social-posts": "Get all social posts",
             "GET /daily-post": "Get today's post",
             "POST /find-leads": "Find leads to contact",
             "GET /outreach-plan": "Get outreach strategy",
-            "POST /process-lead": "Qualify a lead",
+            "POST /process-lead": "Qualify a lead (?prescore=1 answers low-scoring leads locally)",
+            "POST /process-leads": "Qualify many leads in parallel (server-sent events)",
             "POST /inquiry": "Handle sales question",
             "POST /support": "Handle support request",
+            "POST /inquiry/stream": "Sales reply streamed as server-sent events",
+            "POST /support/stream": "Support reply streamed as server-sent events",
             "POST /webhook/payhip": "Payhip sales webhook",
             "POST /webhook/stripe": "Stripe webhook",
-            "GET /stats": "View statistics",
-            "GET /assets": "View all data"
+            "POST /webhook/gumroad": "Gumroad webhook",
+            "GET /webhooks": "Webhook ingestion stats",
+            "GET /stats": "View statistics (?from=&to=&bucket=hour|day for a time range)",
+            "GET /cache": "Response cache stats (DELETE to clear)",
+            "GET /context": "Shared prompt digests and tokens saved per agent",
+            "GET /parse-stats": "Structured output failure and repair rates per agent",
+            "GET /rate-limits": "API request/token budgets and throttling stats",
+            "GET /agents": "Per-agent models, output budgets, deadlines, latency percentiles and hedging stats",
+            "GET /metrics": "Prometheus metrics",
+            "GET /assets": "View all data (?fields=research,product)",
+            "GET /leads": "Leads and outreach history (?cursor=&limit=&fields=), or deduplicated lead queries (?top=20&processed=false&urgency=hot&min_score=)",
+            "GET /customers": "Customers and revenue (?cursor=&limit=&fields=)"
         }
     })
 
 @app.route("/build", methods=["POST"])
 def build():
-    global data
     req = request.json or {}
-    niche = req.get("niche", "AI prompts for solopreneurs")
-    
-    print(f"Building: {niche}")
-    
-    print("1/5 Research...")
-    data["research"] = research_market(niche)
-    
-    print("2/5 Product...")
-    data["product"] = create_product(niche, data["research"])
-    
-    print("3/5 Marketing...")
-    data["marketing"] = create_marketing(data["product"], data["research"])
-    
-    print("4/5 Outreach...")
-    data["outreach_plan"] = create_outreach(niche, data["research"])
-    
-    print("5/5 Leads...")
-    data["initial_leads"] = find_leads(niche, 10)
-    
-    data["config"] = {"niche": niche, "created": datetime.now().isoformat()}
-    
-    with open("business.json", "w") as f:
-        json.dump(data, f, indent=2)
+    ws = workspaces.acquire(workspace_id(), create=True)
+    job = Job(req.get("niche", "AI prompts for solopreneurs"), ws.id)
+    add_job(job)
+    job.start(ws, req.get("concurrency"), req.get("cache", True))
+    return jsonify({
+        "status": job.status,
+        "job_id": job.id,
+        "workspace": ws.id,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events"
+    }), 202
+
+@app.route("/rebuild", methods=["POST"])
+def rebuild():
+    req = request.json or {}
+    fresh = req.get("stages") or []
+    edits = req.get("edits") or {}
+    if not isinstance(fresh, list) or not isinstance(edits, dict):
+        return jsonify({"error": "stages must be a list and edits an object"}), 400
+    unknown = [name for name in [*fresh, *(path.split(".")[0] for path in edits)] if name not in STAGE_OUTPUTS]
+    if unknown:
+        return jsonify({"error": f"Unknown stages: {', '.join(unknown)}", "stages": BUILD_STAGES}), 400
+    if not fresh and not edits:
+        return jsonify({"error": "Pass stages to regenerate and/or edits to apply", "stages": BUILD_STAGES}), 400
+    ws = workspaces.acquire(workspace_id())
+    niche = ws.data.get("config", {}).get("niche")
+    if not niche:
+        workspaces.release(ws)
+        return jsonify({"error": "Build first"}), 400
+    job = Job(niche, ws.id, kind="rebuild")
+    add_job(job)
+    job.start(ws, req.get("concurrency"), req.get("cache", True), set(fresh), edits)
+    return jsonify({
+        "status": job.status,
+        "job_id": job.id,
+        "workspace": ws.id,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events"
+    }), 202
+
+@app.route("/jobs")
+def list_jobs():
+    selected = request.environ.get("workspace") or request.args.get("workspace") or request.headers.get("X-Workspace")
+    found = [job for job in map(find_job, {name[:-6] for name in job_files()} | set(jobs)) if job]
+    found.sort(key=lambda job: job.created, reverse=True)
+    return jsonify({"jobs": [job.summary() for job in found if not selected or job.workspace == selected]})
+
+@app.route("/workspaces")
+def list_workspaces():
+    resident = {id: ws.summary() for id, ws in list(workspaces.resident.items())}
+    return jsonify({
+        **workspaces.stats(),
+        "workspaces": [resident.get(id, {"workspace": id, "resident": False}) for id in workspaces.ids()]
+    })
+
+@app.route("/schedules", methods=["GET", "POST"])
+def schedules_endpoint():
+    ws = workspace()
+    if request.method == "POST":
+        req = request.json or {}
+        tasks, run = req.get("tasks") or {}, req.get("run") or []
+        unknown = [task for task in [*tasks, *run] if task not in SCHEDULE_TASKS]
+        if unknown:
+            return jsonify({"error": f"Unknown tasks: {', '.join(unknown)}. Use: {', '.join(SCHEDULE_TASKS)}"}), 400
+        for task, config in tasks.items():
+            if not isinstance(config, dict) or not isinstance(config.get("every", 1), (int, float)) or config.get("every", 1) <= 0:
+                return jsonify({"error": f"{task}: expected an object with a positive 'every' in seconds"}), 400
+            merged = {**ws.data.get("schedules", {}).get(task, {}).get("config", {}), **config}
+            values = {"config": merged}
+            if "every" in config:
+                values["next_run"] = jittered(datetime.now(), config["every"])
+            ws.store.record("schedule", task=task, values=values)
+        for task in run:
+            ws.store.record("schedule", task=task, values={"next_run": datetime.now().isoformat(), "forced": True})
+    schedules = ws.data.get("schedules", {})
+    return jsonify({
+        "scheduler": background.stats(),
+        "tasks": {task: {**schedules.get(task, {}), "config": schedule_config(ws.data, task)} for task in SCHEDULE_TASKS}
+    })
+
+@app.route("/jobs/<job_id>", methods=["GET", "DELETE"])
+def job_status(job_id):
+    job = find_job(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job"}), 404
+    if request.method == "DELETE" and not job.finished:
+        job.cancel()
+    return jsonify(job.to_dict())
+
+@app.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    if not find_job(job_id):
+        return jsonify({"error": "Unknown job"}), 404
     
-    print("Done!")
+    def stream():
+        sent, idle = 0, 0
+        while True:
+            job = jobs.get(job_id)
+            if job:
+                with job.changed:
+                    if sent >= len(job.events) and not job.finished:
+                        job.changed.wait(15)
+                    events = job.events[sent:]
+                    finished = job.finished
+            else:
+                job = Job.load(job_id)
+                if not job:
+                    return
+                events, finished = job.events[sent:], job.finished
+                if not events and not finished and idle < 15:
+                    gevent.sleep(JOB_POLL)
+                    idle += JOB_POLL
+                    continue
+            idle = 0
+            sent += len(events)
+            if not events:
+                if finished:
+                    return
+                yield ": keepalive\n\n"
+            for event, payload in events:
+                yield sse(event, payload)
     
+    return event_stream(stream())
+
+@app.route("/cache", methods=["GET", "DELETE"])
+def cache_endpoint():
+    if request.method == "DELETE":
+        response_cache.clear()
+    return jsonify(response_cache.stats())
+
+@app.route("/context")
+def context_endpoint():
+    ctx = workspace().context()
+    agents = {}
+    for name, stats in context_stats.items():
+        agents[name] = {**stats, "tokens_saved_per_call": round(stats["tokens_saved"] / stats["calls"]) if stats["calls"] else 0}
     return jsonify({
-        "status": "complete",
-        "product": data["product"].get("product", {}).get("name"),
-        "price": data["product"].get("pricing", {}).get("launch_price"),
-        "leads_found": len(data.get("initial_leads", {}).get("leads", [])),
-        "next_steps": [
-            "GET /payhip-copy - Copy to your store",
-            "GET /find-leads - Contact these people",
-            "GET /daily-post - Post this today",
-            "GET /outreach-plan - Follow this daily"
-        ]
+        "digests": {kind: {"tokens": estimate_tokens(ctx[kind]), "tokens_saved": saved} for kind, saved in ctx["tokens_saved"].items()},
+        "agents": agents
     })
 
+@app.before_request
+def start_timer():
+    g.request_start = time.monotonic()
+    if SCHEDULER_ENABLED:
+        background.start()
+
+@app.after_request
+def record_request(response):
+    if "request_start" in g:
+        metrics.http_seconds.observe(request.endpoint or "unknown", request.method, str(response.status_code),
+                                     value=time.monotonic() - g.request_start)
+    return response
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.teardown_request
+def release_workspace(exc):
+    ws = g.pop("workspace", None)
+    if ws:
+        workspaces.release(ws)
+
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(e):
+    return jsonify({"error": str(e)}), 504
+
+@app.errorhandler(UnknownWorkspace)
+def unknown_workspace(e):
+    return jsonify({"error": str(e)}), 404
+
+@app.route("/agents")
+def agents_endpoint():
+    return jsonify({agent.name: agent.stats() for agent in AGENTS})
+
+@app.route("/rate-limits")
+def rate_limits_endpoint():
+    return jsonify(scheduler.stats())
+
+@app.route("/parse-stats")
+def parse_stats_endpoint():
+    return jsonify({name: {**stats, "failure_rate": round(stats["failures"] / stats["calls"], 3) if stats["calls"] else 0}
+                    for name, stats in parse_stats.items()})
+
 @app.route("/research", methods=["GET", "POST"])
 def research_endpoint():
-    global data
     if request.method == "POST":
-        niche = (request.json or {}).get("niche", "")
-        data["research"] = research_market(niche)
-    return jsonify(data.get("research", {}))
+        req = request.json or {}
+        research = research_market(req.get("niche", ""), req.get("cache", True))
+        workspace(create=True).store.record("set", values={"research": research, "context": build_context(research, workspace().data.get("product", {}))})
+    return jsonify(workspace().data.get("research", {}))
 
 @app.route("/find-leads", methods=["POST"])
 def find_leads_endpoint():
-    global data
     req = request.json or {}
-    niche = req.get("niche", data.get("config", {}).get("niche", ""))
-    count = req.get("count", 10)
-    leads = find_leads(niche, count)
-    data["outreach"].append({"time": datetime.now().isoformat(), "leads": leads})
+    ws = workspace()
+    niche = req.get("niche", ws.data.get("config", {}).get("niche", ""))
+    try:
+        count = int(req.get("count", 10))
+    except (TypeError, ValueError):
+        count = 0
+    if count < 1:
+        return jsonify({"error": "count must be a positive integer"}), 400
+    leads = find_leads(niche, count, req.get("cache", False))
+    ws.store.record("outreach", entry={"time": datetime.now().isoformat(), "leads": leads})
     return jsonify(leads)
 
 @app.route("/outreach-plan")
 def outreach_endpoint():
-    return jsonify(data.get("outreach_plan", {}))
+    return jsonify(workspace().data.get("outreach_plan", {}))
 
 @app.route("/process-lead", methods=["POST"])
 def process_lead_endpoint():
-    global data
     lead_data = request.json or {}
-    result = process_lead(lead_data, data.get("product", {}))
-    data["leads"].append({
+    ws = workspace()
+    scorer = ws.lead_scorer() if request.args.get("prescore") else None
+    if scorer:
+        lead_data = scorer.score([lead_data])[0]
+        if lead_data["prescore"] < LEAD_ESCALATE:
+            result = local_qualification(lead_data)
+            ws.store.record("leads", leads=[lead_record(lead_data, result)])
+            return jsonify(result)
+    result = process_lead(lead_data, ws.context())
+    ws.store.record("leads", leads=[lead_record(lead_data, result)])
+    return jsonify(result)
+
+@app.route("/process-leads", methods=["POST"])
+def process_leads_endpoint():
+    req = request.json or {}
+    ws = workspace()
+    leads = req.get("leads") or ws.store.leads.unprocessed()
+    concurrency = min(int(req.get("concurrency", LEAD_CONCURRENCY)), LEAD_CONCURRENCY)
+    limit = int(req.get("limit", LEAD_ESCALATIONS))
+    scorer = ws.lead_scorer() if req.get("prescore", True) else None
+    if scorer:
+        leads = scorer.score(leads)
+    else:
+        leads = [{**lead, "prescore": LEAD_ESCALATE} for lead in leads]
+    heap = escalation_queue(leads)
+    local = [lead for lead in leads if lead["prescore"] < LEAD_ESCALATE]
+    escalated = min(limit, len(heap))
+    ctx = ws.context()
+    origin = current_origin()
+    
+    def qualify(lead_data):
+        gevent.getcurrent().origin = origin
+        try:
+            return lead_data, process_lead(lead_data, ctx)
+        except Exception as e:
+            return lead_data, {"error": str(e)}
+    
+    def stream():
+        records = [lead_record(lead, local_qualification(lead)) for lead in local]
+        pool = Pool(concurrency)
+        try:
+            yield sse("start", {"leads": len(leads), "local": len(local), "escalated": escalated, "queued": len(heap) - escalated,
+                                "threshold": LEAD_ESCALATE, "concurrency": concurrency})
+            for lead_data, result in pool.imap_unordered(qualify, drain(heap, limit)):
+                if "error" not in result:
+                    records.append(lead_record(lead_data, result))
+                yield sse("lead", {"lead": lead_data, "result": result})
+            yield sse("done", {"processed": len(records), "local": len(local), "failed": len(local) + escalated - len(records)})
+        finally:
+            pool.kill()
+            if records:
+                ws.store.record("leads", leads=records)
+    
+    return event_stream(stream())
+
+def lead_record(lead_data, result):
+    return {
         **lead_data,
         "score": result.get("score", 0),
+        "qualified_by": result.get("qualified_by", "agent"),
         "processed": datetime.now().isoformat()
-    })
-    return jsonify(result)
+    }
 
 @app.route("/inquiry", methods=["POST"])
 def inquiry_endpoint():
     message = (request.json or {}).get("message", "")
-    return jsonify(handle_inquiry(message, data.get("product", {})))
+    ws = workspace()
+    return jsonify(handle_inquiry(message, ws.context(), answers=ws.answers("inquiry")))
 
 @app.route("/support", methods=["POST"])
 def support_endpoint():
     req = request.json or {}
-    return jsonify(handle_support(req.get("message", ""), req.get("customer")))
-
-@app.route("/payhip-copy")
-@app.route("/gumroad-copy")
-def product_copy():
-    copy = data.get("product", {}).get("copy", {})
-    pricing = data.get("product", {}).get("pricing", {})
-    
-    if not copy:
-        return "Build first: POST /build with {\"niche\": \"your niche\"}", 400
-    
-    text = f"""# {copy.get('headline', 'Product')}
-
-## {copy.get('subheadline', '')}
-
-{copy.get('hook', '')}
-
----
-
-## The Problem
-
-{copy.get('problem', '')}
-
----
-
-## The Solution
-
-{copy.get('solution', '')}
-
----
-
-## What You Get:
+    ws = workspace()
+    return jsonify(handle_support(req.get("message", ""), req.get("customer"), ws.context(), answers=ws.answers("support")))
 
-"""
-    for item in copy.get('included', []):
-        text += f"✅ **{item.get('item', '')}** - {item.get('benefit', '')}\n\n"
-    
-    text += "\n## BONUSES:\n\n"
-    for bonus in copy.get('bonuses', []):
-        text += f"🎁 **{bonus.get('name', '')}** ({bonus.get('value', '')})\n\n"
-    
-    text += f"""
----
-
-## 100% Money-Back Guarantee
-
-{copy.get('guarantee', '30-day no questions asked refund')}
-
----
-
-## FAQ
+@app.route("/inquiry/stream", methods=["POST"])
+def inquiry_stream_endpoint():
+    message = (request.json or {}).get("message", "")
+    ws = workspace()
+    return reply_stream(stream_inquiry(message, ws.context(), answers=ws.answers("inquiry")))
 
-"""
-    for faq in copy.get('faq', []):
-        text += f"**Q: {faq.get('q', '')}**\nA: {faq.get('a', '')}\n\n"
-    
-    text += f"""
----
+@app.route("/support/stream", methods=["POST"])
+def support_stream_endpoint():
+    req = request.json or {}
+    ws = workspace()
+    return reply_stream(stream_support(req.get("message", ""), req.get("customer"), ws.context(), answers=ws.answers("support")))
 
-**Launch Price: ${pricing.get('launch_price', 27)}** (Regular ${pricing.get('price', 37)})
+@app.route("/answers", methods=["GET", "POST"])
+def answers_endpoint():
+    ws = workspace()
+    if request.method == "POST":
+        req = request.json or {}
+        question, answer, kind = req.get("question"), req.get("answer"), req.get("kind", "inquiry")
+        if not question or not answer or kind not in ("inquiry", "support"):
+            return jsonify({"error": "question, answer and kind (inquiry/support) required"}), 400
+        ws.store.record("answers", entry={"question": question, "answer": answer, "kind": kind, "time": datetime.now().isoformat()})
+    return jsonify(ws.data.get("answers", []))
+
+@app.route("/retrieval")
+def retrieval_endpoint():
+    ws = workspace()
+    summary = retrieval_summary()
+    summary["indexed"] = {kind: len(ws.answers(kind).entries) for kind in ("inquiry", "support")}
+    return jsonify(summary)
+
+def reply_stream(reply):
+    def stream():
+        for event, payload in reply:
+            yield sse(event, {"text": payload} if event == "token" else payload)
+    return event_stream(stream())
 
-{copy.get('cta', 'Get Instant Access')}
-"""
-    return text, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+@app.route("/payhip-copy")
+@app.route("/gumroad-copy")
+def product_copy():
+    return rendered("product_copy", "Build first: POST /build with {\"niche\": \"your niche\"}")
 
 @app.route("/email-sequence")
 def email_sequence():
-    emails = data.get("marketing", {}).get("emails", {}).get("emails", [])
-    
-    if not emails:
-        return "Build first", 400
-    
-    text = "# Email Sequence\n\n"
-    for e in emails:
-        text += f"""## Email {e.get('number', '')}
-**Send:** {e.get('send', '')}
-**Purpose:** {e.get('purpose', '')}
-**Subject:** {e.get('subject', '')}
-
-{e.get('body', '')}
-
-**CTA:** {e.get('cta', '')}
-
----
-
-"""
-    return text, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    return rendered("email_sequence", "Build first")
 
 @app.route("/social-posts")
 def social_posts():
-    posts = data.get("marketing", {}).get("social", {}).get("posts", [])
-    
-    if not posts:
-        return "Build first", 400
-    
-    text = "# Social Content Calendar\n\n"
-    for p in posts:
-        text += f"""## Day {p.get('day', '')} - {p.get('platform', '').upper()}
-**Type:** {p.get('type', '')}
-
-**Hook:** {p.get('hook', '')}
-
-{p.get('body', '')}
-
-"""
-        if p.get('cta'):
-            text += f"**CTA:** {p.get('cta', '')}\n"
-        if p.get('hashtags'):
-            text += f"**Tags:** {' '.join(p.get('hashtags', []))}\n"
-        text += "\n---\n\n"
-    
-    return text, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    return rendered("social_posts", "Build first")
+
+def rendered(name, missing):
+    entry = workspace().rendered(name)
+    if not entry:
+        return missing, 400
+    body, etag = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return "", 304, headers
+    return bytes(body), 200, {**headers, "Content-Type": "text/plain; charset=utf-8"}
 
 @app.route("/daily-post")
 def daily_post():
-    posts = data.get("marketing", {}).get("social", {}).get("posts", [])
+    data = workspace().data
+    posts, index = social_calendar(data)
     
     if not posts:
         return jsonify({"error": "Build first"})
     
-    created = data.get("config", {}).get("created", datetime.now().isoformat())
-    try:
-        start = datetime.fromisoformat(created.split('.')[0])
-    except:
-        start = datetime.now()
-    
-    days = (datetime.now() - start).days
-    post_index = days % len(posts)
-    
     return jsonify({
-        "day": days + 1,
-        "post": posts[post_index]
+        "day": index + 1,
+        "post": posts[index if index < len(posts) else index % len(posts)],
+        "days_left": max(len(posts) - index - 1, 0)
     })
 
 @app.route("/webhook/payhip", methods=["POST"])
 def payhip_webhook():
-    global data
     sale = request.json or {}
     
     customer = {
         "email": sale.get("buyer_email") or sale.get("email"),
         "price": sale.get("total") or sale.get("price"),
         "source": "payhip",
-        "time": datetime.now().isoformat()
+        "time": datetime.now().isoformat(),
+        "event_id": webhook_event_id("payhip", sale.get("id"), sale.get("transaction_id"), sale.get("sale_id"))
     }
     
-    data["customers"].append(customer)
-    try:
-        data["revenue"] += float(customer.get("price", 0) or 0)
-    except:
-        pass
-    
-    print(f"💰 SALE: {customer['email']} - ${customer.get('price')}")
-    
-    return jsonify({"status": "processed", "customer": customer})
+    return ingest(customer)
 
 @app.route("/webhook/stripe", methods=["POST"])
 def stripe_webhook():
-    global data
     event = request.json or {}
     
     if event.get("type") == "checkout.session.completed":
         session = event.get("data", {}).get("object", {})
         customer = {
             "email": session.get("customer_email"),
-            "price": session.get("amount_total", 0) / 100,
+            "price": (session.get("amount_total") or 0) / 100,
             "source": "stripe",
-            "time": datetime.now().isoformat()
+            "time": datetime.now().isoformat(),
+            "event_id": webhook_event_id("stripe", event.get("id"), session.get("id"))
         }
-        data["customers"].append(customer)
-        data["revenue"] += customer.get("price", 0)
-        print(f"💰 STRIPE: {customer['email']} - ${customer['price']}")
+        return ingest(customer)
     
-    return jsonify({"status": "processed"})
+    return jsonify({"status": "ignored"})
 
 @app.route("/webhook/gumroad", methods=["POST"])
 def gumroad_webhook():
-    global data
     sale = request.form.to_dict() or request.json or {}
     
     customer = {
         "email": sale.get("email"),
         "price": sale.get("price"),
         "source": "gumroad",
-        "time": datetime.now().isoformat()
+        "time": datetime.now().isoformat(),
+        "event_id": webhook_event_id("gumroad", sale.get("sale_id"), sale.get("order_number"))
     }
     
-    data["customers"].append(customer)
-    try:
-        data["revenue"] += float(sale.get("price", 0) or 0)
-    except:
-        pass
-    
-    return jsonify({"status": "processed"})
+    return ingest(customer)
+
+@app.route("/webhooks")
+def webhook_stats():
+    return jsonify(workspace().webhooks.stats())
 
 @app.route("/stats")
 def stats():
-    return jsonify({
+    ws = workspace()
+    data = ws.data
+    result = {
         "product": data.get("product", {}).get("product", {}).get("name", "Not built"),
         "price": data.get("product", {}).get("pricing", {}).get("launch_price", 0),
         "leads": len(data.get("leads", [])),
         "customers": len(data.get("customers", [])),
         "revenue": data.get("revenue", 0),
-        "created": data.get("config", {}).get("created", "Not built yet")
-    })
+        "created": data.get("config", {}).get("created", "Not built yet"),
+        "lead_index": ws.store.leads.stats(),
+        **ws.store.aggregates.totals()
+    }
+    if any(k in request.args for k in ("from", "to", "bucket")):
+        bucket = request.args.get("bucket", "day")
+        try:
+            end = local_time(request.args["to"]) if "to" in request.args else datetime.now()
+            start = local_time(request.args["from"]) if "from" in request.args else end - (timedelta(hours=23) if bucket == "hour" else timedelta(days=6))
+            result["range"] = ws.store.aggregates.query(start, end, bucket)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    return jsonify(result)
 
 @app.route("/assets")
 def assets():
-    return jsonify(data)
+    ws = workspace()
+    fields = [f for f in request.args.get("fields", "").split(",") if f]
+    return json_response(chunks=asset_chunks(ws, [k for k in ws.data if not fields or k in fields]))
+
+def asset_chunks(ws, keys):
+    yield b"{"
+    for i, key in enumerate(keys):
+        yield f'{"," if i else ""}{json.dumps(key)}:'.encode()
+        raw = ws.asset(key)
+        if raw is None:
+            yield from encode_json(ws.data[key])
+            continue
+        for start in range(0, len(raw), STREAM_CHUNK):
+            yield bytes(raw[start:start + STREAM_CHUNK])
+    yield b"}"
 
 @app.route("/leads")
 def get_leads():
-    return jsonify({
-        "leads": data.get("leads", []),
-        "initial_leads": data.get("initial_leads", {}),
-        "outreach_history": data.get("outreach", [])
-    })
+    try:
+        offsets, limit, fields = page_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if any(arg in request.args for arg in ("top", "urgency", "processed", "min_score")):
+        return lead_query(workspace().store.leads, fields)
+    data = workspace().data
+    return paged_response(
+        {"leads": data.get("leads", []), "outreach_history": data.get("outreach", [])},
+        fields, limit, offsets,
+        initial_leads=data.get("initial_leads", {})
+    )
+
+def lead_query(leads, fields):
+    try:
+        top = min(int(request.args.get("top", PAGE_SIZE)), MAX_PAGE_SIZE)
+        offset = int(request.args.get("offset", 0))
+        min_score = float(request.args["min_score"]) if request.args.get("min_score") else None
+    except ValueError:
+        return jsonify({"error": "top, offset and min_score must be numbers"}), 400
+    urgency = [u for u in request.args.get("urgency", "").split(",") if u]
+    if any(u not in (*LEAD_URGENCIES, "unknown") for u in urgency):
+        return jsonify({"error": f"urgency must be one of: {', '.join((*LEAD_URGENCIES, 'unknown'))}"}), 400
+    processed = {"true": True, "false": False}.get(request.args.get("processed", "").lower())
+    found, total = leads.query(processed, urgency, min_score, max(top, 1), max(offset, 0))
+    if fields:
+        found = [{f: lead.get(f) for f in fields} for lead in found]
+    return json_response({"leads": found, "matched": total, "total": len(leads.leads)})
 
 @app.route("/customers")
 def get_customers():
-    return jsonify({
-        "customers": data.get("customers", []),
-        "count": len(data.get("customers", [])),
-        "revenue": data.get("revenue", 0)
-    })
+    try:
+        offsets, limit, fields = page_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    data = workspace().data
+    return paged_response(
+        {"customers": data.get("customers", [])},
+        fields, limit, offsets,
+        count=len(data.get("customers", [])),
+        revenue=data.get("revenue", 0)
+    )
+
 
-# Load existing data on startup
 if __name__ == "__main__":
-    try:
-        with open("business.json", "r") as f:
-            data = json.load(f)
-            print("Loaded existing data")
-    except:
-        print("Starting fresh")
-    
     port = int(os.environ.get("PORT", 8080))
     print(f"Running on port {port}")
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file
@@ -0,0 +1,469 @@
+import os
+import tempfile
+from datetime import datetime
+
+STATE_DIR = tempfile.mkdtemp(prefix="autobusiness-test-")
+os.environ.update({
+    "STATE_FILE": os.path.join(STATE_DIR, "business.json"),
+    "EVENT_LOG": os.path.join(STATE_DIR, "events.log"),
+    "WORKSPACE_DIR": os.path.join(STATE_DIR, "workspaces"),
+    "JOB_DIR": os.path.join(STATE_DIR, "jobs"),
+    "SCHEDULER": "0"
+})
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+os.environ.pop("CACHE_DB", None)
+
+import gevent
+import pytest
+
+import main
+
+
+# Structured Output
+SCHEMA = main.schema_for({
+    "response": "reply",
+    "score": 8,
+    "close_ready": False,
+    "persona": {"name": "name", "fears": ["concern"]}
+})
+
+def test_schema_for_marks_root_keys_required():
+    assert SCHEMA["required"] == ["response", "score", "close_ready", "persona"]
+    assert "required" not in SCHEMA["properties"]["persona"]
+    assert SCHEMA["properties"]["persona"]["properties"]["fears"] == {"type": "array", "items": {"type": "string"}}
+
+def test_validate_accepts_matching_value():
+    assert main.validate({"response": "hi", "score": 3, "close_ready": True, "persona": {"name": "A", "fears": ["x"]}}, SCHEMA) == []
+
+def test_validate_rejects_null_required_key():
+    errors = main.validate({"response": None, "score": 3, "close_ready": True, "persona": {}}, SCHEMA)
+    assert errors == ["$.response must be a string"]
+
+def test_validate_allows_null_optional_field():
+    assert main.validate({"response": "hi", "score": 3, "close_ready": True, "persona": {"name": None, "fears": None}}, SCHEMA) == []
+
+def test_validate_reports_missing_and_wrong_types():
+    errors = main.validate({"response": "hi", "score": True, "persona": {"fears": [1]}}, SCHEMA)
+    assert errors == ["$.close_ready is missing", "$.score must be a number", "$.persona.fears[0] must be a string"]
+
+def test_task_schema_reads_return_json_example():
+    schema = main.task_schema('Do it.\n\nReturn JSON:\n{\n    "intent": "buy",\n    "close_ready": false\n}')
+    assert schema["required"] == ["intent", "close_ready"]
+    assert main.task_schema("No example here") is None
+
+
+# Streaming
+def test_field_stream_yields_field_text_across_chunks():
+    stream = main.FieldStream("response")
+    chunks = ['{"intent": "buy", "resp', 'onse": "Hel', 'lo \\"you\\"', '\\n\\u00e9', '", "next": "x"}']
+    assert "".join(stream.feed(chunk) for chunk in chunks) == 'Hello "you"\né'
+    assert stream.done
+
+def test_field_stream_waits_for_complete_escapes():
+    stream = main.FieldStream("response")
+    assert stream.feed('{"response": "a\\') == "a"
+    assert stream.feed('u00') == ""
+    assert stream.feed('e9b"') == "éb"
+
+
+
+# Shared Context
+def test_build_context_reports_digest_savings():
+    product = {"product": {"name": "Guide", "sections": [{"title": "One", "content": "x" * 2000}]}, "pricing": {"price": 29}}
+    ctx = main.build_context({}, product)
+    assert ctx["product"] == 'Product: {"name":"Guide","sections":["One"],"price":29}'
+    assert ctx["tokens_saved"]["product"] > 400
+    system = main.sales_closer.params("task", shared=ctx["sales"])["system"]
+    assert system.endswith(ctx["sales"]) and "cache_control" not in str(system)
+
+
+# Event Log
+def open_store(folder):
+    store = main.Store(os.path.join(folder, "business.json"), os.path.join(folder, "events.log"))
+    store.load()
+    return store
+
+def sale(event_id, price=10):
+    return {"event_id": event_id, "price": price}
+
+def test_store_replays_log_without_snapshot(tmp_path):
+    store = open_store(tmp_path)
+    store.record("customers", customers=[sale("a")])
+    store.record("set", values={"config": {"niche": "x"}})
+    store.sync()
+    replayed = open_store(tmp_path)
+    assert replayed.seq == 2
+    assert replayed.data["revenue"] == 10
+    assert replayed.data["config"] == {"niche": "x"}
+    assert replayed.versions == {"config": 2}
+
+def test_store_truncates_torn_tail_before_appending(tmp_path):
+    store = open_store(tmp_path)
+    store.record("customers", customers=[sale("a")])
+    store.sync()
+    with open(store.log_path, "ab") as f:
+        f.write(b'{"seq": 2, "type": "cust')
+    restarted = open_store(tmp_path)
+    assert os.path.getsize(restarted.log_path) == restarted.log_bytes
+    restarted.record("customers", customers=[sale("b")])
+    restarted.record("customers", customers=[sale("c")])
+    restarted.sync()
+    assert [c["event_id"] for c in open_store(tmp_path).data["customers"]] == ["a", "b", "c"]
+
+def test_store_catch_up_stops_at_torn_line_from_another_writer(tmp_path):
+    store = open_store(tmp_path)
+    other = open_store(tmp_path)
+    other.record("customers", customers=[sale("a")])
+    with open(store.log_path, "ab") as f:
+        f.write(b'{"seq": 2, "type": "cust')
+    store.refresh()
+    assert store.seq == 1
+    store.record("customers", customers=[sale("b")])
+    store.record("customers", customers=[sale("c")])
+    store.sync()
+    assert [c["event_id"] for c in open_store(tmp_path).data["customers"]] == ["a", "b", "c"]
+
+def test_registry_refreshes_outside_its_lock(tmp_path, monkeypatch):
+    registry = main.WorkspaceRegistry(str(tmp_path))
+    with registry.use("shop", create=True):
+        pass
+    
+    def try_lock():
+        if registry.lock.acquire(blocking=False):
+            registry.lock.release()
+            return True
+        return False
+    
+    free = []
+    monkeypatch.setattr(main.Workspace, "refresh", lambda ws: free.append(gevent.spawn(try_lock).get()))
+    with registry.use("shop"):
+        pass
+    assert free == [True]
+
+
+
+# Webhook Ingestion
+def test_webhook_ingest_dedupes_pending_and_committed(tmp_path):
+    ingest = main.WebhookIngest(open_store(tmp_path))
+    assert ingest.submit(sale("a")) == "queued"
+    assert ingest.submit(sale("a")) == "duplicate"
+    ingest.start()
+    ingest.stop()
+    assert ingest.submit(sale("a")) == "duplicate"
+    assert ingest.committed == 1 and ingest.idle()
+
+def test_webhook_ingest_retries_failed_batches(tmp_path, monkeypatch):
+    store = open_store(tmp_path)
+    record = store.record
+    failures = [OSError("disk full")] * 2
+    
+    def flaky(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return record(*args, **kwargs)
+    
+    monkeypatch.setattr(store, "record", flaky)
+    ingest = main.WebhookIngest(store)
+    ingest.retry_delay = 0.001
+    ingest.start()
+    ingest.submit(sale("a"))
+    gevent.sleep(0)
+    assert ingest.submit(sale("a")) == "duplicate"
+    ingest.stop()
+    assert ingest.failures == 2 and ingest.committed == 1
+    assert [c["event_id"] for c in store.data["customers"]] == ["a"]
+
+def test_webhook_ingest_drains_queue_on_stop(tmp_path):
+    store = open_store(tmp_path)
+    ingest = main.WebhookIngest(store)
+    ingest.batch_size = 2
+    ingest.start()
+    for event_id in "abcde":
+        ingest.submit(sale(event_id))
+    ingest.stop()
+    assert len(store.data["customers"]) == 5 and ingest.idle()
+
+
+
+# Answer Retrieval
+FAQ = [
+    {"question": "How do refunds work?", "answer": "Full refund within 30 days.", "source": "faq"},
+    {"question": "Is there a mobile app?", "answer": "Not yet.", "source": "faq"},
+    {"question": "?", "answer": "Ask away.", "source": "approved"}
+]
+
+def test_answer_index_ranks_near_duplicates_first():
+    index = main.AnswerIndex(FAQ)
+    score, entry = index.search("how do refunds work")[0]
+    assert entry is FAQ[0] and score >= main.ANSWER_THRESHOLD
+    assert index.search("zzzz qqqq") == []
+
+def test_answer_index_skips_questions_without_ngrams():
+    index = main.AnswerIndex(FAQ)
+    assert FAQ[2] not in index.entries
+    assert main.AnswerIndex([FAQ[2]]).search("anything") == []
+
+def test_retrieve_answers_grounds_or_misses():
+    index = main.AnswerIndex(FAQ)
+    match, grounding = main.retrieve(index, "inquiry", "How do refunds work")
+    assert match[1] is FAQ[0] and grounding == ""
+    assert main.retrieve(index, "inquiry", "completely unrelated words") == (None, "")
+
+
+
+# Sharded Generation
+def test_find_leads_endpoint_parses_count(monkeypatch):
+    counts = []
+    monkeypatch.setattr(main, "find_leads", lambda niche, count, cache=True: counts.append(count) or {"leads": [], "search_queries": []})
+    client = main.app.test_client()
+    assert client.post("/find-leads", json={"niche": "x", "count": "20"}).status_code == 200
+    assert counts == [20]
+    for count in ("twenty", None, 0, [5]):
+        assert client.post("/find-leads", json={"niche": "x", "count": count}).status_code == 400
+
+
+# Lead Index
+def lead(identifier, **fields):
+    return {"type": "reddit", "identifier": identifier, **fields}
+
+def test_lead_store_merges_on_normalized_key():
+    store = main.LeadStore()
+    store.insert(lead("U/Alice", signal="old", urgency="warm"), found="2026-10-01T00:00:00")
+    merged = store.insert({"type": "Reddit", "identifier": "u alice", "signal": "new", "pain_point": ""}, found="2026-10-02T00:00:00")
+    assert len(store.leads) == 1
+    assert merged["signal"] == "new"
+    assert merged["seen"] == 2
+    assert merged["found"] == "2026-10-01T00:00:00"
+    assert store.merges == 1
+    assert store.get("reddit", "U/Alice") is merged
+
+def test_lead_store_skips_leads_without_identifier():
+    store = main.LeadStore()
+    assert store.insert({"type": "reddit", "identifier": ""}) is None
+    assert not store.leads
+
+def test_lead_store_query_filters_and_orders():
+    store = main.LeadStore()
+    store.add([lead("a", urgency="hot"), lead("b", urgency="hot"), lead("c", urgency="cold"), lead("d", urgency="??")], found="2026-10-01")
+    store.add([lead("a", score=4, processed="2026-10-03"), lead("c", score=9, processed="2026-10-03")])
+
+    found, total = store.query(processed=False, urgency=["hot"])
+    assert [l["identifier"] for l in found] == ["b"] and total == 1
+
+    found, total = store.query(processed=True)
+    assert [l["identifier"] for l in found] == ["c", "a"] and total == 2
+
+    found, total = store.query(min_score=5)
+    assert [l["identifier"] for l in found] == ["c"] and total == 1
+
+    found, total = store.query(processed=False, limit=1, offset=1)
+    assert [l["identifier"] for l in found] == ["b"] and total == 2
+    assert store.query(urgency=["unknown"])[0][0]["identifier"] == "d"
+
+def test_lead_store_from_state_matches_incremental():
+    state = main.empty_state()
+    live = main.LeadStore()
+    events = [
+        {"type": "outreach", "time": "2026-10-01T00:00:00", "entry": {"time": "2026-10-01T00:00:00", "leads": {"leads": [lead("a", urgency="hot"), lead("b")]}}},
+        {"type": "outreach", "time": "2026-10-02T00:00:00", "entry": {"time": "2026-10-02T00:00:00", "leads": {"leads": [lead("A", urgency="hot")]}}},
+        {"type": "leads", "time": "2026-10-03T00:00:00", "leads": [lead("b", score=7, processed="2026-10-03T00:00:00")]}
+    ]
+    for event in events:
+        main.apply_event(state, event)
+        live.apply(event)
+    rebuilt = main.LeadStore.from_state(state)
+    assert rebuilt.stats() == live.stats()
+    assert rebuilt.query()[0] == live.query()[0]
+
+
+# Aggregates
+def test_aggregates_query_buckets_by_day_and_hour():
+    state = main.empty_state()
+    state["customers"] = [{"price": "10", "time": "2026-10-01T09:15:00"}, {"price": 5, "time": "2026-10-01T10:00:00"}]
+    state["leads"] = [{"score": 8, "processed": "2026-10-02T12:00:00"}]
+    aggregates = main.Aggregates.from_state(state)
+
+    days = aggregates.query(datetime(2026, 10, 1), datetime(2026, 10, 2))
+    assert [b["sales"] for b in days["series"]] == [2, 0]
+    assert days["totals"] == {"sales": 2, "revenue": 15.0, "leads": 1, "conversion_rate": 2.0}
+
+    hours = aggregates.query(datetime(2026, 10, 1, 9), datetime(2026, 10, 1, 10), "hour")
+    assert [b["bucket"] for b in hours["series"]] == ["2026-10-01T09", "2026-10-01T10"]
+    assert aggregates.lead_scores[8] == 1
+
+def test_aggregates_count_each_lead_once_and_move_rescored_scores():
+    aggregates = main.Aggregates()
+    aggregates.apply({"type": "leads", "leads": [
+        {"type": "reddit", "identifier": "u/a", "score": 8, "processed": "2026-10-01T09:00:00"},
+        {"type": "reddit", "identifier": "u/b", "score": 3, "processed": "2026-10-01T09:00:00"}
+    ]})
+    aggregates.apply({"type": "leads", "leads": [{"type": "Reddit", "identifier": "U/A", "score": 5, "processed": "2026-10-02T09:00:00"}]})
+    aggregates.add_sale({"price": 10, "time": "2026-10-02T10:00:00"})
+    assert aggregates.leads == 2
+    assert aggregates.lead_scores[8] == 0 and aggregates.lead_scores[5] == 1 and aggregates.lead_scores[3] == 1
+    assert aggregates.totals()["conversion_rate"] == 0.5
+    assert aggregates.daily["2026-10-01"]["leads"] == 1
+    assert aggregates.daily["2026-10-02"]["leads"] == 1
+
+def test_aggregates_query_rejects_bad_bucket_and_huge_range():
+    aggregates = main.Aggregates()
+    with pytest.raises(ValueError):
+        aggregates.query(datetime(2026, 10, 1), datetime(2026, 10, 2), "minute")
+    with pytest.raises(ValueError):
+        aggregates.query(datetime(2000, 1, 1), datetime(2026, 1, 1), "hour")
+
+def test_stats_range_validation():
+    client = main.app.test_client()
+    response = client.get("/stats?from=2026-10-01T00:00:00%2B00:00&to=2026-10-03T00:00:00%2B00:00")
+    assert response.status_code == 200
+    assert len(response.json["range"]["series"]) == 3
+    assert client.get("/stats?bucket=minute").status_code == 400
+    assert client.get("/stats?from=yesterday").status_code == 400
+
+
+# Pipeline
+def test_pipeline_reuses_stages_with_matching_inputs():
+    calls = []
+
+    def stage(name, value):
+        def run(**inputs):
+            calls.append(name)
+            return value
+        return run
+
+    def pipeline():
+        p = main.Pipeline(key="niche")
+        p.stage("a", stage("a", 1))
+        p.stage("b", stage("b", 2), ["a"])
+        p.stage("c", stage("c", 3), ["b"])
+        return p
+
+    first = pipeline()
+    results = first.run()
+    assert results == {"a": 1, "b": 2, "c": 3}
+
+    calls.clear()
+    seen = []
+    reuse = {"a": (first.hashes["a"], 1), "b": (first.hashes["b"], 2), "c": ("stale", 3)}
+    second = pipeline()
+    assert second.run(on_stage=lambda name, result, reused=False: seen.append((name, reused)), reuse=reuse) == results
+    assert calls == ["c"]
+    assert second.reused == ["a", "b"]
+    assert seen == [("a", True), ("b", True), ("c", False)]
+
+def test_pipeline_rejects_unresolvable_stages():
+    p = main.Pipeline()
+    p.stage("a", lambda missing: 1, ["missing"])
+    with pytest.raises(ValueError):
+        p.run()
+
+
+# Pagination
+def test_cursor_round_trip():
+    offsets = {"leads": 100, "outreach_history": 20}
+    cursor = main.encode_cursor(offsets)
+    assert "=" not in cursor
+    assert main.decode_cursor(cursor) == offsets
+    assert main.decode_cursor(None) == {}
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", main.encode_cursor(["list"]), main.encode_cursor({"leads": "x"})])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        main.decode_cursor(cursor)
+
+
+
+# Lead Scoring
+RESEARCH = {"audience": {"persona": {"language": ["burnout from client work"], "biggest_problem": "pricing freelance projects", "hangouts": ["reddit"]}}}
+
+def test_lead_scorer_ranks_matching_hot_leads_higher():
+    now = datetime(2026, 10, 10).timestamp()
+    leads = [
+        {"type": "reddit", "identifier": "a", "signal": "burnout pricing freelance projects", "urgency": "hot", "found": "2026-10-10T00:00:00"},
+        {"type": "linkedin", "identifier": "b", "signal": "likes coffee", "urgency": "cold", "found": "2026-08-01T00:00:00"}
+    ]
+    hot, cold = main.LeadScorer(RESEARCH).score(leads, now)
+    assert hot["prescore"] == 10.0
+    assert cold["prescore"] < main.LEAD_ESCALATE < hot["prescore"]
+    assert main.LeadScorer({}).vocab == set()
+
+def test_escalation_queue_drains_best_first():
+    leads = [{"identifier": i, "prescore": score} for i, score in enumerate([6, 2, 9, 7])]
+    heap = main.escalation_queue(leads)
+    assert [lead["identifier"] for lead in main.drain(heap, 2)] == [2, 3]
+    assert [lead["identifier"] for lead in main.drain(heap, 5)] == [0]
+
+def test_local_qualification_marks_prescored_leads():
+    result = main.local_qualification({"prescore": 3.0, "approach": "hi"})
+    assert result["qualified_by"] == "prescore" and result["score"] == 3.0 and result["intent"] == "warm"
+
+
+def test_process_lead_gates_only_when_asked(monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "process_lead", lambda lead, ctx, cache=True: calls.append(lead) or {"score": 7, "response": "hello"})
+    with main.workspaces.use("gating", create=True) as ws:
+        ws.store.record("set", values={"research": RESEARCH})
+    client = main.app.test_client()
+    cold = {"type": "linkedin", "identifier": "cold", "signal": "likes coffee", "urgency": "cold"}
+    assert client.post("/w/gating/process-lead", json=cold).json["response"] == "hello"
+    assert client.post("/w/gating/process-lead?prescore=1", json=cold).json["qualified_by"] == "prescore"
+    assert len(calls) == 1
+
+
+# Background Scheduler
+def built_workspace(id, **schedules):
+    with main.workspaces.use(id, create=True) as ws:
+        ws.store.record("set", values={"config": {"niche": "test", "created": datetime.now().isoformat()}})
+        for task, values in schedules.items():
+            ws.store.record("schedule", task=task, values=values)
+        return ws
+
+def test_scheduler_lease_runs_a_due_task_once(monkeypatch):
+    runs = []
+    monkeypatch.setitem(main.SCHEDULE_TASKS, "find_leads", lambda ws, config: runs.append(ws.id) or {"leads": 0})
+    built_workspace("leased", find_leads={"next_run": "2026-01-01T00:00:00"})
+    first, second = main.BackgroundScheduler(), main.BackgroundScheduler()
+    first.check()
+    second.check()
+    first.pool.join()
+    second.pool.join()
+    assert runs == ["leased"]
+    with main.workspaces.use("leased") as ws:
+        state = ws.data["schedules"]["find_leads"]
+        assert state["runs"] == 1 and state["lease"] is None
+        assert datetime.fromisoformat(state["next_run"]) > datetime.now()
+        assert all("next_run" in ws.data["schedules"][task] for task in main.SCHEDULE_TASKS)
+
+def test_scheduler_skips_unbuilt_workspaces():
+    with main.workspaces.use("unbuilt", create=True):
+        pass
+    os.remove(main.schedule_index_path(main.workspaces.paths("unbuilt")[0]))
+    main.workspaces.close()
+    loads = main.workspaces.loads
+    main.BackgroundScheduler().check()
+    assert main.workspaces.loads == loads
+    assert os.path.getsize(main.workspaces.paths("unbuilt")[1]) == 0
+
+def test_requalify_replaces_stale_lead_records(monkeypatch):
+    stale = {"type": "reddit", "identifier": "u/a", "score": 8, "processed": "2026-01-01T00:00:00"}
+    ws = built_workspace("requalify")
+    ws.store.record("leads", leads=[stale])
+    monkeypatch.setattr(main, "process_lead", lambda lead, ctx, cache=True: {"score": 6})
+    with main.workspaces.use("requalify") as ws:
+        assert main.scheduled_requalify(ws, {"stale_days": 1, "limit": 10})["requalified"] == 1
+        main.scheduled_requalify(ws, {"stale_days": 1, "limit": 10})
+        assert [lead["score"] for lead in ws.data["leads"]] == [6]
+        assert ws.store.aggregates.leads == 1
+        assert ws.store.aggregates.lead_scores[8] == 0 and ws.store.aggregates.lead_scores[6] == 1
+        live = ws.store.aggregates
+    main.workspaces.close()
+    with main.workspaces.use("requalify") as ws:
+        assert ws.store.aggregates.lead_scores == live.lead_scores
+        assert {day: counts["leads"] for day, counts in ws.store.aggregates.daily.items() if counts["leads"]} == {day: counts["leads"] for day, counts in live.daily.items() if counts["leads"]}
+
+def test_daily_post_day_follows_social_calendar():
+    ws = built_workspace("social")
+    start = (datetime.now() - main.timedelta(days=2)).isoformat()
+    ws.store.record("set", values={"marketing": {"social": {"start": start, "posts": [{"day": day, "hook": hook} for day, hook in enumerate(["one", "two", "three", "four"], 1)]}}})
+    response = main.app.test_client().get("/w/social/daily-post")
+    assert response.json == {"day": 3, "post": {"day": 3, "hook": "three"}, "days_left": 1}